@@ -102,6 +102,34 @@ def simulate_real_links(net, links, min_bw=SAT_BANDWIDTH, max_bw=ETH_BANDWIDTH,
     change_link_bandwidth(net, link[0], link[1], new_bw, current_link_bandwidths)
     # sleep(LINK_CHANGE_INTERVAL)
 
+def host_rx_bytes(host):
+    return int(host.cmd(f'cat /sys/class/net/{host.defaultIntf()}/statistics/rx_bytes'))
+
+def measure_link_failure_recovery(net, node1, node2, receiver, sample_interval=0.2, timeout=30, recovered_fraction=0.9):
+    # Throughput of the receiver before the failure, over one second
+    start_bytes = host_rx_bytes(receiver)
+    sleep(1)
+    baseline = host_rx_bytes(receiver) - start_bytes
+    info(f"*** Throughput at {receiver.name} before the failure: {baseline * 8 / 1e6:.2f} Mbps\n")
+
+    info(f"*** Taking link between {node1} and {node2} down\n")
+    net.configLinkStatus(node1, node2, 'down')
+    failure_time = time.time()
+
+    last_bytes = host_rx_bytes(receiver)
+    while time.time() - failure_time < timeout:
+        sleep(sample_interval)
+        rx_bytes = host_rx_bytes(receiver)
+        rate = (rx_bytes - last_bytes) / sample_interval
+        last_bytes = rx_bytes
+        if baseline and rate >= recovered_fraction * baseline:
+            recovery_time = time.time() - failure_time
+            info(f"*** Throughput at {receiver.name} recovered {recovery_time:.2f} s after the failure\n")
+            return recovery_time
+
+    info(f"*** Throughput at {receiver.name} did not recover within {timeout} s\n")
+    return None
+
 def setup_servers(net):
     def server_thread(host):
         host.cmd(f"python3 server.py {host.IP()} 10001 &")
@@ -227,6 +255,7 @@ def main():
         CLI(net)
         
         start_n_flows(net, 25)
+        # measure_link_failure_recovery(net, 's1', 's2', net.hosts[1])
 
         # CLI(net)
 
@@ -0,0 +1,73 @@
+"""
+IP to MAC bindings learned from packet-ins, used to answer ARP requests from
+the controller instead of broadcasting them.
+
+Where a MAC sits in the network (switch and port) is already known from the
+host learning of the controller, so the table only keeps the IP to MAC half.
+"""
+import socket
+import struct
+
+
+ARP_REQUEST = 1
+ARP_REPLY = 2
+
+_ETH_ARP_PACKET = struct.Struct('!6s6sHHHBBH6s4s6s4s')
+
+
+class ArpTable(object):
+
+    def __init__(self):
+        self.ip_to_mac = {}
+        self.learned = 0
+        self.hits = 0
+        self.misses = 0
+
+    def learn(self, ip, mac):
+        """
+        Record that an IP address belongs to a MAC address.
+        """
+        if ip is None or ip == '0.0.0.0':
+            return
+        if self.ip_to_mac.get(ip) != mac:
+            self.ip_to_mac[ip] = mac
+            self.learned += 1
+
+    def lookup(self, ip):
+        """
+        Return the MAC address of an IP address, None on a miss.
+        """
+        mac = self.ip_to_mac.get(ip)
+        if mac is None:
+            self.misses += 1
+        else:
+            self.hits += 1
+        return mac
+
+    def stats(self):
+        """
+        Return the size of the table and how often it answered.
+        """
+        lookups = self.hits + self.misses
+        return {
+            'entries': len(self.ip_to_mac),
+            'learned': self.learned,
+            'hits': self.hits,
+            'misses': self.misses,
+            'hit_rate': self.hits / lookups if lookups else 0.0,
+        }
+
+
+def arp_reply(requester_mac, requester_ip, target_mac, target_ip):
+    """
+    Build the Ethernet frame of the ARP reply target_mac would send to the
+    requester.
+    """
+    requester_mac = bytes.fromhex(requester_mac.replace(':', ''))
+    target_mac = bytes.fromhex(target_mac.replace(':', ''))
+    return _ETH_ARP_PACKET.pack(
+        requester_mac, target_mac, 0x0806,
+        1, 0x0800, 6, 4, ARP_REPLY,  # Ethernet hardware, IPv4 protocol
+        target_mac, socket.inet_aton(target_ip),
+        requester_mac, socket.inet_aton(requester_ip),
+    )
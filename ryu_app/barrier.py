@@ -0,0 +1,66 @@
+"""
+Barrier requests the controller can wait on.
+
+A barrier reply from a datapath means every message sent to it before the
+barrier request has been processed, so waiting for the replies of a set of
+datapaths tells when the rules sent to them are in place.
+"""
+import time
+
+from ryu.lib import hub
+
+
+class BarrierTracker(object):
+
+    def __init__(self, logger, timeout=1, batcher=None):
+        self.logger = logger
+        self.timeout = timeout  # Seconds to wait for the replies of one wait() call
+        self.batcher = batcher  # MessageBatcher the barriers are sent through, behind the queued messages
+        self._pending = {}  # (dpid, xid) to the hub.Event set by the reply
+        self.sent = 0
+        self.timeouts = 0
+
+    def send(self, datapath):
+        """
+        Send a barrier request to a datapath and return the event its reply sets.
+        """
+        reply = hub.Event()
+        if self.batcher is not None:
+            request = self.batcher.barrier(datapath)
+            self._pending[(datapath.id, request.xid)] = reply
+            self.batcher.flush(datapath.id)
+        else:
+            request = datapath.ofproto_parser.OFPBarrierRequest(datapath)
+            datapath.set_xid(request)
+            self._pending[(datapath.id, request.xid)] = reply
+            datapath.send_msg(request)
+        self.sent += 1
+        return reply
+
+    def reply(self, msg):
+        """
+        Wake up whoever waits for the barrier a reply answers.
+        """
+        reply = self._pending.pop((msg.datapath.id, msg.xid), None)
+        if reply is not None:
+            reply.set()
+
+    def wait(self, datapaths):
+        """
+        Send a barrier to every datapath and wait for all the replies, at
+        most timeout seconds in total. Returns False if some did not arrive.
+        """
+        datapaths = {datapath.id: datapath for datapath in datapaths}.values()
+        replies = [(datapath.id, self.send(datapath)) for datapath in datapaths]
+        deadline = time.time() + self.timeout
+        complete = True
+        for dpid, reply in replies:
+            if not reply.wait(max(deadline - time.time(), 0)):
+                self.logger.warning("No barrier reply from datapath %s", dpid)
+                complete = False
+        if not complete:
+            self.timeouts += 1
+            # Forget the barriers that timed out, a late reply is ignored
+            timed_out = [reply for dpid, reply in replies if not reply.is_set()]
+            self._pending = {key: reply for key, reply in self._pending.items() if reply not in timed_out}
+        return complete
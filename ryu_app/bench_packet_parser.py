@@ -0,0 +1,76 @@
+"""
+Micro-benchmark of packet-in parsing: the fast classifier of packet_parser
+against the full Ryu packet parser the controller used before.
+
+Run inside the controller container: python3 bench_packet_parser.py
+"""
+import sys
+import timeit
+
+from ryu.lib.packet import packet, ethernet, arp, ipv4, tcp, udp, icmp
+
+import packet_parser
+
+
+def build_packets():
+    """
+    Build one serialized packet per kind of traffic seen by the controller.
+    """
+    src, dst = '00:00:00:00:00:01', '00:00:00:00:00:02'
+    src_ip, dst_ip = '10.0.0.1', '10.0.0.2'
+    packets = {}
+
+    pkt = packet.Packet()
+    pkt.add_protocol(ethernet.ethernet(dst=dst, src=src, ethertype=0x0800))
+    pkt.add_protocol(ipv4.ipv4(src=src_ip, dst=dst_ip, proto=6))
+    pkt.add_protocol(tcp.tcp(src_port=40000, dst_port=5001, bits=tcp.TCP_SYN))
+    pkt.serialize()
+    packets['tcp'] = bytes(pkt.data)
+
+    pkt = packet.Packet()
+    pkt.add_protocol(ethernet.ethernet(dst=dst, src=src, ethertype=0x0800))
+    pkt.add_protocol(ipv4.ipv4(src=src_ip, dst=dst_ip, proto=17))
+    pkt.add_protocol(udp.udp(src_port=40000, dst_port=5001))
+    pkt.add_protocol(b'x' * 64)
+    pkt.serialize()
+    packets['udp'] = bytes(pkt.data)
+
+    pkt = packet.Packet()
+    pkt.add_protocol(ethernet.ethernet(dst=dst, src=src, ethertype=0x0800))
+    pkt.add_protocol(ipv4.ipv4(src=src_ip, dst=dst_ip, proto=1))
+    pkt.add_protocol(icmp.icmp(data=icmp.echo(id_=1, seq=1, data=b'x' * 56)))
+    pkt.serialize()
+    packets['icmp'] = bytes(pkt.data)
+
+    pkt = packet.Packet()
+    pkt.add_protocol(ethernet.ethernet(dst='ff:ff:ff:ff:ff:ff', src=src, ethertype=0x0806))
+    pkt.add_protocol(arp.arp_ip(arp.ARP_REQUEST, src, src_ip, '00:00:00:00:00:00', dst_ip))
+    pkt.serialize()
+    packets['arp'] = bytes(pkt.data)
+
+    return packets
+
+
+def parse_ryu(data):
+    """
+    The parsing the packet-in handler did before the fast classifier.
+    """
+    pkt = packet.Packet(data)
+    eth = pkt.get_protocols(ethernet.ethernet)[0]
+    tcp_pkt = pkt.get_protocol(tcp.tcp)
+    udp_pkt = pkt.get_protocol(udp.udp)
+    return eth, tcp_pkt, udp_pkt
+
+
+def main(number=20000):
+    packets = build_packets()
+    print(f"{'packet':<8}{'ryu pkt/s':>14}{'fast pkt/s':>14}{'speedup':>10}")
+    for name, data in packets.items():
+        assert packet_parser.parse_fast(data) == packet_parser.parse_full(data), name
+        ryu_time = timeit.timeit(lambda: parse_ryu(data), number=number)
+        fast_time = timeit.timeit(lambda: packet_parser.parse(data), number=number)
+        print(f"{name:<8}{number / ryu_time:>14,.0f}{number / fast_time:>14,.0f}{ryu_time / fast_time:>9.1f}x")
+
+
+if __name__ == '__main__':
+    main(int(sys.argv[1]) if len(sys.argv) > 1 else 20000)
@@ -0,0 +1,182 @@
+"""
+Store of the flows routed by the controller.
+
+Every flow is a FlowRecord with __slots__ that is created once and updated in
+place from the flow stats replies, so a stats cycle allocates nothing per flow
+and a record costs a fraction of the memory of a dict.
+
+Every flow also gets a compact integer id that is used as the cookie of its
+rules, so a flow stats entry maps back to its flow with a single lookup.
+
+The rate of a flow is estimated from the last few byte count samples of its
+rule instead of its lifetime average, so a flow that loses its bandwidth shows
+it within a polling interval.
+"""
+import time
+from collections import deque
+
+
+REVERSE_COOKIE = 1 << 63  # Set in the cookie of the rules of the reverse direction of a flow
+
+class RateEstimator(object):
+    """
+    Rate of a flow from a small ring buffer of (timestamp, byte_count) samples.
+    """
+    __slots__ = ('samples', 'alpha', 'instantaneous', 'ewma', 'peak')
+
+    def __init__(self, window=4, alpha=0.5):
+        self.samples = deque(maxlen=window)
+        self.alpha = alpha  # Weight of the newest sample in the EWMA
+        self.instantaneous = 0
+        self.ewma = 0
+        self.peak = 0
+
+    def add(self, timestamp, byte_count):
+        """
+        Add a sample and update the instantaneous, EWMA and peak rates.
+        """
+        if self.samples:
+            last_timestamp, last_byte_count = self.samples[-1]
+            if timestamp <= last_timestamp or byte_count < last_byte_count:
+                # The rule was reinstalled and its counters reset
+                self.samples.clear()
+            else:
+                self.instantaneous = (byte_count - last_byte_count) / (timestamp - last_timestamp)
+
+        if not self.samples and timestamp > 0:
+            # First sample of the rule, its lifetime average is the best guess
+            self.instantaneous = byte_count / timestamp
+
+        self.ewma = self.alpha * self.instantaneous + (1 - self.alpha) * self.ewma if self.ewma else self.instantaneous
+
+        self.samples.append((timestamp, byte_count))
+        self.peak = max(self.instantaneous, self._window_peak())
+
+    def _window_peak(self):
+        peak = 0
+        previous = None
+        for sample in self.samples:
+            if previous is not None:
+                peak = max(peak, (sample[1] - previous[1]) / (sample[0] - previous[0]))
+            previous = sample
+        return peak
+
+
+class FlowRecord(object):
+    __slots__ = (
+        'key',  # (src mac, dst mac, tp_src, tp_dst)
+        'cookie',  # Flow id, used as the cookie of the flow's rules
+        'path',  # Switches the flow is routed over, followed by the destination host
+        'backup_path',  # Path sharing no link with path, used if path fails
+        'current_rate',
+        'desired_rate',
+        'update_time',
+        'active',
+        'input_port',
+        'ip_proto',  # IP protocol the rules of the flow match
+        'recent_rerouting_countdown',
+        'rate',  # RateEstimator of the flow
+    )
+
+    def __init__(self, key, cookie, desired_rate, input_port=None, window=4, alpha=0.5, ip_proto=6):
+        self.key = key
+        self.cookie = cookie
+        self.path = []
+        self.backup_path = []
+        self.current_rate = 0
+        self.desired_rate = desired_rate
+        self.update_time = time.time()
+        self.active = True
+        self.input_port = input_port
+        self.ip_proto = ip_proto
+        self.recent_rerouting_countdown = 0
+        self.rate = RateEstimator(window, alpha)
+
+    def __repr__(self):
+        return f"FlowRecord({self.key}, path={self.path}, rate={self.current_rate}, active={self.active})"
+
+
+class FlowStore(object):
+
+    def __init__(self, desired_rate, window=4, alpha=0.5):
+        self.desired_rate = desired_rate
+        self.window = window  # Number of byte count samples kept per flow
+        self.alpha = alpha  # EWMA weight of the newest rate sample
+        self._flows = {}  # Flow key to FlowRecord
+        self._by_cookie = {}  # Cookie to FlowRecord
+        self._next_cookie = 1  # Cookie 0 is left to rules that do not belong to a flow
+
+    def __len__(self):
+        return len(self._flows)
+
+    def __contains__(self, key):
+        return key in self._flows
+
+    def __getitem__(self, key):
+        return self._flows[key]
+
+    def __iter__(self):
+        return iter(self._flows.values())
+
+    def get(self, key):
+        return self._flows.get(key)
+
+    def by_cookie(self, cookie):
+        return self._by_cookie.get(cookie)
+
+    def add(self, key, input_port=None, ip_proto=6):
+        """
+        Return the record of a flow, creating it if the flow is new.
+        """
+        flow = self._flows.get(key)
+        if flow is None:
+            cookie = self._next_cookie
+            self._next_cookie += 1
+            flow = FlowRecord(key, cookie, self.desired_rate, input_port, self.window, self.alpha, ip_proto)
+            self._flows[key] = self._by_cookie[cookie] = flow
+        return flow
+
+    def remove(self, key):
+        """
+        Forget a flow, returning its record.
+        """
+        flow = self._flows.pop(key)
+        del self._by_cookie[flow.cookie]
+        return flow
+
+    def active(self):
+        """
+        Iterate over the active flows.
+        """
+        return (flow for flow in self._flows.values() if flow.active)
+
+    def update_from_stats(self, dpid, body, change_threshold=0.25):
+        """
+        Update the flows of a flow stats reply body from switch dpid in place.
+
+        Flows are found by the cookie of their rule. Rate samples are only
+        taken from the ingress switch of a flow, the rules on the other
+        switches have their own counters and durations. Returns the number of
+        sampled flows whose instantaneous rate differs from their previous
+        EWMA rate by more than change_threshold.
+        """
+        now = time.time()
+        changed = 0
+        for stat in body:
+            # The reverse direction rules carry REVERSE_COOKIE and are not sampled
+            flow = self._by_cookie.get(stat.cookie)
+            if flow is None:
+                continue
+
+            if not flow.path or flow.path[0] == dpid:
+                # The rule duration is a more precise clock than the reply arrival time
+                previous_rate = flow.rate.ewma
+                flow.rate.add(stat.duration_sec + stat.duration_nsec / 1e9, stat.byte_count)
+                flow.current_rate = flow.rate.ewma
+                if abs(flow.rate.instantaneous - previous_rate) > change_threshold * previous_rate:
+                    changed += 1
+            flow.update_time = now
+            flow.active = True  # Assuming flow is active if stats exist
+            flow.input_port = stat.match.in_port
+            flow.recent_rerouting_countdown = 0
+        return changed
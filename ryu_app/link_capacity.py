@@ -0,0 +1,76 @@
+"""
+Link capacities read from the link bandwidth file written by the Mininet
+experiment script.
+
+The file is only parsed again when its modification time or size changes,
+and every reload reports which links changed so the controller can react to
+real capacity deltas.
+"""
+import json
+import os
+
+from ryu.controller import event
+
+
+class EventLinkCapacityChanged(event.EventBase):
+    """
+    Event raised when the capacity of a directed link changes.
+    """
+
+    def __init__(self, link_key, old_capacity, new_capacity):
+        super(EventLinkCapacityChanged, self).__init__()
+        self.link_key = link_key
+        self.old_capacity = old_capacity
+        self.new_capacity = new_capacity
+
+
+class LinkCapacityStore(object):
+
+    def __init__(self, path):
+        self.path = path
+        self.capacities = {}  # Link key ('src-dst') to capacity
+        self.reloads = 0
+        self._signature = None
+
+    def get(self, link_key, default=0):
+        """
+        Return the capacity of a link.
+        """
+        return self.capacities.get(link_key, default)
+
+    def reload(self):
+        """
+        Re-read the file if it changed since the last reload.
+
+        Returns a dict of link key to (old capacity, new capacity) for every
+        link whose capacity changed, empty if nothing did.
+        """
+        try:
+            stat = os.stat(self.path)
+        except OSError:
+            return {}
+
+        signature = (stat.st_mtime_ns, stat.st_size)
+        if signature == self._signature:
+            return {}
+
+        try:
+            with open(self.path, 'r') as f:
+                capacities = json.load(f)
+        except (OSError, ValueError):
+            # The file is being rewritten, try again on the next reload
+            return {}
+
+        self._signature = signature
+        self.reloads += 1
+
+        changes = {}
+        for link_key, capacity in capacities.items():
+            old_capacity = self.capacities.get(link_key, 0)
+            if capacity != old_capacity:
+                changes[link_key] = (old_capacity, capacity)
+        for link_key in self.capacities.keys() - capacities.keys():
+            changes[link_key] = (self.capacities[link_key], 0)
+
+        self.capacities = capacities
+        return changes
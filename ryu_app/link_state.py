@@ -0,0 +1,102 @@
+"""
+Edge-indexed link state used to score candidate paths.
+
+Capacity, usage and flow count of every directed link live in NumPy arrays
+indexed by a stable edge id. A set of paths is represented as a padded
+path x hop matrix of edge ids, so scoring all of them is a single gather and
+min-reduction instead of a Python loop over hops.
+"""
+import numpy as np
+
+
+PAD_EDGE = 0  # Edge id used to pad short paths, it never limits a path
+
+
+class LinkStateMatrix(object):
+
+    def __init__(self, initial_size=64):
+        self.edge_ids = {}  # Link key ('src-dst') to edge id
+        self.capacity = np.zeros(initial_size)
+        self.usage = np.zeros(initial_size)
+        self.flows = np.zeros(initial_size, dtype=np.int64)
+        self._size = 1  # Edge id 0 is reserved for padding
+
+    def edge_id(self, link_key):
+        """
+        Return the edge id of a link, allocating one if the link is new.
+        """
+        edge_id = self.edge_ids.get(link_key)
+        if edge_id is None:
+            edge_id = self._size
+            if edge_id == len(self.capacity):
+                self._grow()
+            self.edge_ids[link_key] = edge_id
+            self._size += 1
+        return edge_id
+
+    def _grow(self):
+        size = 2 * len(self.capacity)
+        for name in ('capacity', 'usage', 'flows'):
+            old = getattr(self, name)
+            new = np.zeros(size, dtype=old.dtype)
+            new[:len(old)] = old
+            setattr(self, name, new)
+
+    def set_link(self, link_key, capacity=None, usage=None):
+        """
+        Update the capacity and/or usage of a link.
+        """
+        self.update_edge(self.edge_id(link_key), capacity, usage)
+
+    def update_edge(self, edge_id, capacity=None, usage=None):
+        """
+        Update the capacity and/or usage of a link by edge id.
+        """
+        if capacity is not None:
+            self.capacity[edge_id] = capacity
+        if usage is not None:
+            self.usage[edge_id] = usage
+
+    def path_edges(self, path):
+        """
+        Return the edge ids of the consecutive hops of a path.
+        """
+        return [self.edge_id(f'{path[i]}-{path[i + 1]}') for i in range(len(path) - 1)]
+
+    def add_flows(self, edge_ids, delta, rate=0):
+        """
+        Add delta to the flow count of every given edge, and delta times rate
+        to its usage until the next port stats overwrite it.
+        """
+        np.add.at(self.flows, edge_ids, delta)
+        if rate:
+            np.add.at(self.usage, edge_ids, delta * rate)
+
+    def incidence(self, paths):
+        """
+        Build the padded path x hop edge id matrix of a list of paths.
+        """
+        rows = [self.path_edges(path) for path in paths]
+        width = max([len(row) for row in rows] + [1])
+        matrix = np.full((len(rows), width), PAD_EDGE, dtype=np.intp)
+        for i, row in enumerate(rows):
+            matrix[i, :len(row)] = row
+        return matrix
+
+    def expected_throughput(self):
+        """
+        Return the throughput a new flow can expect on every edge: the larger
+        of the unused capacity and its fair share of the capacity.
+        """
+        capacity = self.capacity[:self._size]
+        available = capacity - self.usage[:self._size]
+        fair_share = capacity / (self.flows[:self._size] + 1)
+        expected = np.maximum(available, fair_share)
+        expected[PAD_EDGE] = np.inf
+        return expected
+
+    def score(self, incidence):
+        """
+        Return the bottleneck throughput of every path of an incidence matrix.
+        """
+        return self.expected_throughput()[incidence].min(axis=1)
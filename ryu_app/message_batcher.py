@@ -0,0 +1,86 @@
+"""
+Outbound OpenFlow messages batched per datapath.
+
+Messages queued while a handler runs are serialized as they are queued and
+written to their datapath with a single send once the handler yields, instead
+of one socket write per message. Every flush is counted so the number of
+messages and bytes per write can be compared with sending them one by one.
+"""
+from ryu.lib import hub
+
+
+class MessageBatcher(object):
+
+    def __init__(self, logger):
+        self.logger = logger
+        self._queues = {}  # dpid to (datapath, list of serialized messages)
+        self._scheduled = False
+        self.flushes = 0
+        self.messages = 0
+        self.bytes = 0
+        self.max_messages = 0  # Most messages written by a single flush
+
+    def send(self, datapath, msg):
+        """
+        Queue a message for a datapath, it is sent by the next flush.
+        """
+        if msg.xid is None:
+            datapath.set_xid(msg)
+        msg.serialize()
+        queue = self._queues.get(datapath.id)
+        if queue is None or queue[0] is not datapath:
+            if queue is not None:
+                # The switch reconnected, the old connection cannot take the messages anymore
+                self.logger.debug("Dropping %s messages queued for datapath %s", len(queue[1]), datapath.id)
+            queue = self._queues[datapath.id] = (datapath, [])
+        queue[1].append(msg.buf)
+
+        if not self._scheduled:
+            # Flush once the current handler gives control back to the hub
+            self._scheduled = True
+            hub.spawn(self._flush_scheduled)
+
+    def barrier(self, datapath):
+        """
+        Queue a barrier request behind the messages queued for a datapath and
+        return it.
+        """
+        request = datapath.ofproto_parser.OFPBarrierRequest(datapath)
+        self.send(datapath, request)
+        return request
+
+    def flush(self, dpid=None):
+        """
+        Write the queued messages of one datapath, or of all of them.
+        """
+        dpids = list(self._queues) if dpid is None else [dpid]
+        for dpid in dpids:
+            queue = self._queues.pop(dpid, None)
+            if queue is None:
+                continue
+            datapath, bufs = queue
+            buf = b''.join(bufs)
+            if not datapath.send(buf):
+                self.logger.warning("Could not send %s messages to datapath %s", len(bufs), dpid)
+                continue
+            self.flushes += 1
+            self.messages += len(bufs)
+            self.bytes += len(buf)
+            self.max_messages = max(self.max_messages, len(bufs))
+            self.logger.debug("Flushed %s messages (%s bytes) to datapath %s", len(bufs), len(buf), dpid)
+
+    def _flush_scheduled(self):
+        self._scheduled = False
+        self.flush()
+
+    def stats(self):
+        """
+        Return the number of flushes and the messages and bytes they wrote.
+        """
+        return {
+            'flushes': self.flushes,
+            'messages': self.messages,
+            'bytes': self.bytes,
+            'messages_per_flush': self.messages / self.flushes if self.flushes else 0.0,
+            'max_messages': self.max_messages,
+        }
@@ -0,0 +1,107 @@
+"""
+Fast classifier for packet-in data.
+
+The Ethernet, ARP, IPv4 and TCP/UDP headers are read in place with
+struct.unpack_from over a memoryview of the packet, instead of building the
+full ryu.lib.packet protocol stack. Packets the fast path does not handle
+(VLAN tags, truncated headers) are handed to the full parser, which returns
+the same PacketHeaders.
+"""
+import socket
+import struct
+from collections import namedtuple
+
+from ryu.lib.packet import packet, ethernet, vlan, arp, ipv4, tcp, udp
+
+
+PacketHeaders = namedtuple('PacketHeaders', [
+    'dst', 'src', 'ethertype',
+    'ip_proto', 'src_port', 'dst_port',
+    'src_ip', 'dst_ip',  # IPv4 addresses, or ARP sender and target addresses
+    'arp_op',
+])
+
+ETH_TYPE_IP = 0x0800
+ETH_TYPE_ARP = 0x0806
+ETH_TYPE_VLAN = 0x8100
+IPPROTO_TCP = 6
+IPPROTO_UDP = 17
+
+_ETH_HEADER = struct.Struct('!6s6sH')  # dst, src, ethertype
+_IPV4_HEADER = struct.Struct('!B5xHxB2x4s4s')  # version and header length, flags and fragment offset, protocol, src, dst
+_ARP_HEADER = struct.Struct('!6xH6x4s6x4s')  # opcode, sender IP, target IP
+_L4_PORTS = struct.Struct('!HH')  # src port, dst port
+_ETH_LEN = _ETH_HEADER.size
+
+
+def parse(data):
+    """
+    Return the PacketHeaders of packet-in data, None if it is not Ethernet.
+    """
+    headers = parse_fast(data)
+    if headers is None:
+        headers = parse_full(data)
+    return headers
+
+
+def parse_fast(data):
+    """
+    Read the headers of an untagged Ethernet frame without copying the
+    packet, or return None if the full parser has to handle it.
+    """
+    if len(data) < _ETH_LEN:
+        return None
+    view = memoryview(data)
+    dst, src, ethertype = _ETH_HEADER.unpack_from(view)
+    if ethertype == ETH_TYPE_VLAN:
+        return None
+
+    ip_proto = src_port = dst_port = src_ip = dst_ip = arp_op = None
+    if ethertype == ETH_TYPE_IP:
+        if len(data) < _ETH_LEN + _IPV4_HEADER.size:
+            return None
+        version_ihl, fragment, ip_proto, src_ip, dst_ip = _IPV4_HEADER.unpack_from(view, _ETH_LEN)
+        if version_ihl >> 4 != 4:
+            return None
+        src_ip, dst_ip = socket.inet_ntoa(src_ip), socket.inet_ntoa(dst_ip)
+        # Only the first fragment carries the L4 header
+        if ip_proto in (IPPROTO_TCP, IPPROTO_UDP) and not fragment & 0x1fff:
+            l4_offset = _ETH_LEN + (version_ihl & 0xf) * 4
+            if len(data) < l4_offset + _L4_PORTS.size:
+                return None
+            src_port, dst_port = _L4_PORTS.unpack_from(view, l4_offset)
+    elif ethertype == ETH_TYPE_ARP:
+        if len(data) < _ETH_LEN + _ARP_HEADER.size:
+            return None
+        arp_op, src_ip, dst_ip = _ARP_HEADER.unpack_from(view, _ETH_LEN)
+        src_ip, dst_ip = socket.inet_ntoa(src_ip), socket.inet_ntoa(dst_ip)
+
+    return PacketHeaders(dst.hex(':'), src.hex(':'), ethertype, ip_proto, src_port, dst_port, src_ip, dst_ip, arp_op)
+
+
+def parse_full(data):
+    """
+    Read the headers of a packet with the full Ryu packet parser.
+    """
+    pkt = packet.Packet(data)
+    eth = pkt.get_protocol(ethernet.ethernet)
+    if eth is None:
+        return None
+
+    ethertype = eth.ethertype
+    vlan_tag = pkt.get_protocol(vlan.vlan)
+    if vlan_tag is not None:
+        ethertype = vlan_tag.ethertype
+
+    ip = pkt.get_protocol(ipv4.ipv4)
+    l4 = pkt.get_protocol(tcp.tcp) or pkt.get_protocol(udp.udp)
+    arp_pkt = pkt.get_protocol(arp.arp)
+    return PacketHeaders(
+        eth.dst, eth.src, ethertype,
+        ip.proto if ip is not None else None,
+        l4.src_port if l4 is not None else None,
+        l4.dst_port if l4 is not None else None,
+        ip.src if ip is not None else arp_pkt.src_ip if arp_pkt is not None else None,
+        ip.dst if ip is not None else arp_pkt.dst_ip if arp_pkt is not None else None,
+        arp_pkt.opcode if arp_pkt is not None else None,
+    )
@@ -0,0 +1,71 @@
+"""
+Cache of the K shortest simple paths between two nodes.
+
+Candidate paths only change when the topology does, so entries are keyed on
+the topology epoch of the controller and dropped as soon as it moves on.
+Each entry also keeps the edge incidence matrix of its paths, so scoring them
+needs no per-hop work.
+"""
+from collections import OrderedDict, namedtuple
+from itertools import islice
+
+import networkx as nx
+
+
+CandidatePaths = namedtuple('CandidatePaths', ['paths', 'incidence'])
+
+
+class PathCache(object):
+
+    def __init__(self, incidence, k=10, max_entries=1024):
+        self.incidence = incidence  # Builds the edge incidence matrix of a list of paths
+        self.k = k  # Number of shortest paths to keep per pair
+        self.max_entries = max_entries
+        self._paths = OrderedDict()
+        self._epoch = None
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.invalidations = 0
+
+    def get(self, graph, src, dst, epoch):
+        """
+        Return up to K shortest simple paths from src to dst as tuples along
+        with their incidence matrix, computing them with Yen's algorithm on a
+        miss.
+        """
+        if epoch != self._epoch:
+            if self._paths:
+                self.invalidations += 1
+            self._paths.clear()
+            self._epoch = epoch
+
+        key = (src, dst)
+        candidates = self._paths.get(key)
+        if candidates is not None:
+            self.hits += 1
+            self._paths.move_to_end(key)
+            return candidates
+
+        self.misses += 1
+        paths = tuple(tuple(path) for path in islice(nx.shortest_simple_paths(graph, src, dst), self.k))
+        candidates = CandidatePaths(paths, self.incidence(paths))
+        self._paths[key] = candidates
+        if len(self._paths) > self.max_entries:
+            self._paths.popitem(last=False)
+            self.evictions += 1
+        return candidates
+
+    def stats(self):
+        """
+        Return the hit/miss counters of the cache.
+        """
+        lookups = self.hits + self.misses
+        return {
+            'entries': len(self._paths),
+            'hits': self.hits,
+            'misses': self.misses,
+            'hit_rate': self.hits / lookups if lookups else 0.0,
+            'evictions': self.evictions,
+            'invalidations': self.invalidations,
+        }
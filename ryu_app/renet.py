@@ -1,40 +1,114 @@
-import json
 from ryu.base import app_manager
 from ryu.controller import ofp_event
-from ryu.controller.handler import CONFIG_DISPATCHER, MAIN_DISPATCHER
+from ryu.controller.handler import CONFIG_DISPATCHER, MAIN_DISPATCHER, DEAD_DISPATCHER
 from ryu.controller.handler import set_ev_cls
 from ryu.ofproto import ofproto_v1_0
-from ryu.topology.api import get_switch, get_link
 from ryu.topology import event
-from ryu.lib.packet import packet, ethernet, tcp, udp
 import networkx as nx
-import matplotlib.pyplot as plt
+import numpy as np
 from ryu.app.ofctl.api import get_datapath
 from ryu.lib import hub
 import time
-from ryu.lib import mac
+
+from arp_proxy import ARP_REQUEST, ArpTable, arp_reply
+from barrier import BarrierTracker
+from flow_store import REVERSE_COOKIE, FlowStore
+from link_capacity import EventLinkCapacityChanged, LinkCapacityStore
+from link_state import LinkStateMatrix
+from message_batcher import MessageBatcher
+import packet_parser
+from packet_parser import ETH_TYPE_ARP, ETH_TYPE_IP, IPPROTO_TCP, IPPROTO_UDP
+from path_cache import PathCache
+from stats_scheduler import StatsScheduler
+from topology_exporter import TopologySnapshotExporter
 
 
 DESIRED_RATE = 1000000  # 1 Mbps
 
 REROUTE_LIMIT = 1000000
 
+STATS_ADAPTIVE = True  # Poll busy switches faster and quiet ones slower
+STATS_MIN_INTERVAL = 1  # Seconds
+STATS_MAX_INTERVAL = 20  # Seconds
+HOT_LINK_UTILIZATION = 0.8  # Fraction of capacity above which a link is busy
+RATE_CHANGE_THRESHOLD = 0.25  # Relative flow rate change above which a switch is busy
+
+FLOW_IDLE_TIMEOUT = 1  # Seconds without traffic before a flow rule expires
+BIDIRECTIONAL_FLOWS = True  # Also install the reverse direction of a flow, so its ACKs do not come to the controller
+
+# Forward on destination MAC rules along the spanning tree, with per-flow rules
+# only at the ingress switch and on the paths of rerouted flows. This cuts the
+# transit rules, not the packet-ins: see install_tree_rules
+AGGREGATE_FORWARDING = False
+TREE_RULE_PRIORITY = 0  # Below the per-flow rules
+
+ARP_PROXY = True  # Answer ARP requests for known hosts from the controller instead of flooding them
+
+RECOVERY_FRACTION = 0.9  # Fraction of its rate before a failure a flow has to get back to count as recovered
+RECOVERY_TIMEOUT = 30  # Seconds after a failure a flow stops being watched for recovery
+BARRIER_TIMEOUT = 1  # Seconds a reroute waits for the switches to confirm its rules
+
+RATE_WINDOW = 4  # Byte count samples kept per flow for rate estimation
+RATE_EWMA_ALPHA = 0.5  # Weight of the newest sample in the flow rate EWMA
+
+K_PATHS = 10  # Number of shortest paths to consider
+PATH_CACHE_SIZE = 1024  # Maximum number of cached switch pairs
+
+LINK_BANDWIDTHS_FILE = '/mn_scripts/link_bandwidths.json'  # Written by setup_mininet_experiement.py
+CAPACITY_POLL_INTERVAL = 1  # Seconds between checks of the link bandwidth file
+
+SNAPSHOT_DIR = None  # Directory for topology snapshots, None disables the exporter
+SNAPSHOT_FORMATS = ('json', 'graphml')
+SNAPSHOT_INTERVAL = 5  # Minimum seconds between two snapshots
+SNAPSHOT_PNG = False  # Also render PNGs with every snapshot, this loads matplotlib
+
 
 class RENETController(app_manager.RyuApp):
     OFP_VERSIONS = [ofproto_v1_0.OFP_VERSION]
+    _EVENTS = [EventLinkCapacityChanged]
 
     def __init__(self, *args, **kwargs):
         super(RENETController, self).__init__(*args, **kwargs)
         self.network_graph = nx.DiGraph()  # Network topology
+        self.switch_graph = nx.DiGraph()  # Switch-only view of the topology used for routing
         self.mst = nx.Graph()  # Minimum Spanning Tree
         self.mac_to_port = {}  # MAC to port mapping on switches
         self.mac_to_switch = {}  # MAC to switch mapping for hosts
-        self.blocked_ports = {}
+        self.blocked_ports = {}  # dpid to the set of its ports with flooding disabled
+        self.port_mods = 0  # PortMods sent to program the broadcast tree
+        self.port_map = {}  # (dpid, port_no) to (neighbor, edge id, reverse edge id)
+        self.host_ports = {}  # dpid to the set of ports hosts are attached to
+        self.tree_rules = {}  # Host MAC to {dpid: {in_port: out_port}} of its destination rules
+        self.protocol_rules = set()  # (host MAC, IP protocol) pairs forwarded by destination rules
+        self.arp_table = ArpTable()  # IP to MAC bindings learned from packet-ins
+        self.failovers = {}  # Flow key to (failure time, rate before the failure) until the flow recovered
+        self.rule_counts = {}  # dpid to the number of rules in its flow table
+        self.packet_in_counts = {'packet_ins': 0, 'flow_setups': 0, 'duplicates': 0, 'released': 0}
+        self.pending_setups = {}  # Flow key to the packet-ins that arrived while its rules were being installed
         self.datapaths = {}
         self.stats_interval = 5
-        self.flow_store = {}  # Store flow metrics
+        self.stats_scheduler = StatsScheduler(
+            self.logger, self.stats_interval, self._send_stats_request, self._stats_cycle,
+            adaptive=STATS_ADAPTIVE, min_interval=STATS_MIN_INTERVAL, max_interval=STATS_MAX_INTERVAL)
+        self.stats_traffic = {'requests': 0, 'request_bytes': 0, 'replies': 0, 'reply_bytes': 0}  # OpenFlow stats messages
+        self.stats_scheduler.start()
+        self.flow_store = FlowStore(DESIRED_RATE, RATE_WINDOW, RATE_EWMA_ALPHA)  # Store flow metrics
         self.link_store = {}  # Store link metrics
-        self.flows_per_link = {}  # Store flows per link
+        self.port_counters = {}  # (dpid, port_no) to (time, rx_bytes) of the last port stats
+        self.link_state = LinkStateMatrix()  # Capacity, usage and flows per link, indexed by edge id
+        self.flows_by_link = {}  # Link key to the set of flow keys routed over it
+        self.batcher = MessageBatcher(self.logger)  # FlowMods, PortMods and PacketOuts, one write per datapath and tick
+        self.barriers = BarrierTracker(self.logger, BARRIER_TIMEOUT, self.batcher)  # Barrier requests reroutes wait on
+        self.link_capacities = LinkCapacityStore(LINK_BANDWIDTHS_FILE)  # Link capacities, reloaded on change
+        self.link_capacities.reload()
+        hub.spawn(self._watch_link_capacities)
+        self.topology_epoch = 0  # Bumped on every switch or link change
+        self.path_cache = PathCache(self.link_state.incidence, K_PATHS, PATH_CACHE_SIZE)  # K shortest paths per switch pair
+        self.snapshot_exporter = None
+        if SNAPSHOT_DIR is not None:
+            self.snapshot_exporter = TopologySnapshotExporter(
+                self.logger, SNAPSHOT_DIR, SNAPSHOT_FORMATS, SNAPSHOT_INTERVAL, SNAPSHOT_PNG)
+            self.snapshot_exporter.start()
 
     # @set_ev_cls(ofp_event.EventOFPSwitchFeatures, CONFIG_DISPATCHER)
     # def switch_features_handler(self, ev):
@@ -70,9 +144,52 @@ class RENETController(app_manager.RyuApp):
         datapath = ev.switch.dp
         # keep track of datapath
         # self.datapaths[ev.switch.dp.id] = ev.switch.dp
-        hub.spawn(self._send_stats_request, datapath)
-        self.update_topology()
+        self.stats_scheduler.register(datapath)
+        self.add_switch(datapath)
+
+    @set_ev_cls(ofp_event.EventOFPStateChange, DEAD_DISPATCHER)
+    def state_change_handler(self, ev):
+        """
+        Stop polling a switch that disconnected.
+        """
+        if ev.datapath.id is not None:
+            self.stats_scheduler.unregister(ev.datapath.id)
+
+    @set_ev_cls(event.EventSwitchLeave)
+    def switch_leave_handler(self, ev):
+        """
+        Fail over the flows crossing a switch that left.
+        """
+        dpid = ev.switch.dp.id
+        self.stats_scheduler.unregister(dpid)
+        self.datapaths.pop(dpid, None)
+        links = [(dpid, neighbor) for neighbor in self.switch_graph.neighbors(dpid)] if dpid in self.switch_graph else []
+        self.fail_links(links, "Switch Left")
+
+    @set_ev_cls(event.EventLinkDelete)
+    def link_delete_handler(self, ev):
+        """
+        Fail over the flows crossing a link that was deleted.
+        """
+        self.fail_links([(ev.link.src.dpid, ev.link.dst.dpid)], "Link Deleted")
+
+    @set_ev_cls(ofp_event.EventOFPPortStatus, MAIN_DISPATCHER)
+    def port_status_handler(self, ev):
+        """
+        Fail over the flows crossing a switch link whose port went down,
+        without waiting for link discovery to time out.
+        """
+        msg = ev.msg
+        ofproto = msg.datapath.ofproto
+        port = msg.desc
+        down = (msg.reason == ofproto.OFPPR_DELETE or port.state & ofproto.OFPPS_LINK_DOWN
+                or port.config & ofproto.OFPPC_PORT_DOWN)
+        if not down:
+            return
 
+        neighbor = self.port_map.get((msg.datapath.id, port.port_no))
+        if neighbor is not None and neighbor[0] in self.switch_graph:
+            self.fail_links([(msg.datapath.id, neighbor[0])], "Port Down")
 
     @set_ev_cls(event.EventLinkAdd)
     def link_add_handler(self, ev):
@@ -81,103 +198,397 @@ class RENETController(app_manager.RyuApp):
         """
         src = ev.link.src.dpid
         dst = ev.link.dst.dpid
-        self.flows_per_link[f'{src}-{dst}'] = 0
-        self.flows_per_link[f'{dst}-{src}'] = 0
-        with open('/mn_scripts/link_bandwidths.json', 'r') as f:
-            current_link_bandwidths = json.load(f)
-            link_key = f"{src}-{dst}"
-            link_key2 = f"{dst}-{src}"
-            new_link_info = {
-                'src_dst': link_key,
-                'usage': 0,
-                'recieved_bytes': 0,
-                'desired_rate': 1000000,  # 1 Mbps
-                'update_time': time.time(),
-                'active': True,  # Assuming link is active if stats exist
-            }
-            new_link_info['current_bandwidth'] = current_link_bandwidths.get(link_key, 0)
-            self.link_store[link_key] = self.link_store[link_key2] = new_link_info
-        self.update_topology()
-
-    def update_topology(self):
-        """
-        Build or update the network graph.
-        """
-
-        for dpid, ports in self.blocked_ports.items():
-            for port_no in ports:
-                self.set_port_flooding(dpid, port_no, enable=True)
-        self.blocked_ports.clear()
-        self.network_graph.clear()
-
-        # Add switches as nodes
-        switches = get_switch(self, None)
-        for switch in switches:
-            dpid = switch.dp.id
-            self.datapaths[dpid] = switch.dp
-            self.network_graph.add_node(dpid, type='switch')
-
-        # Add hosts as nodes (from MAC mapping)
-        for mac, switch_info in self.mac_to_switch.items():
-            switch_dpid = switch_info['dpid']
-            port_no = switch_info['port']
-            self.network_graph.add_node(mac, type='host')
-            self.network_graph.add_edge(mac, switch_dpid, dst_port=port_no)
-            self.network_graph.add_edge(switch_dpid, mac, src_port=port_no)
-
-        # Add links as edges
-        links = get_link(self, None)
-        print(links)
-        for link in links:
-            src = link.src.dpid
-            dst = link.dst.dpid
-            src_port = link.src.port_no
-            dst_port = link.dst.port_no
-            if src not in self.network_graph.nodes:
-                self.logger.warning(f"Switch {src} not found in network graph.")
-                continue
-            if dst not in self.network_graph.nodes:
-                self.logger.warning(f"Switch {dst} not found in network graph.")
-                continue
-            # Add bidirectional edges with the correct attributes
-            self.network_graph.add_edge(src, dst, src_port=src_port, dst_port=dst_port)
-            self.network_graph.add_edge(dst, src, src_port=dst_port, dst_port=src_port)
+        link_key = f"{src}-{dst}"
+        link_key2 = f"{dst}-{src}"
+        new_link_info = {
+            'src_dst': link_key,
+            'usage': 0,
+            'recieved_bytes': 0,
+            'desired_rate': 1000000,  # 1 Mbps
+            'update_time': time.time(),
+            'active': True,  # Assuming link is active if stats exist
+        }
+        new_link_info['current_bandwidth'] = self.link_capacities.get(link_key)
+        self.link_store[link_key] = self.link_store[link_key2] = new_link_info
+        self.link_state.set_link(link_key, new_link_info['current_bandwidth'], 0)
+        self.link_state.set_link(link_key2, new_link_info['current_bandwidth'], 0)
+        self.add_link(src, dst, ev.link.src.port_no, ev.link.dst.port_no)
+
+    def add_switch(self, datapath):
+        """
+        Add a switch to the network graph and the spanning tree.
+        """
+        dpid = datapath.id
+        self.datapaths[dpid] = datapath
+        if dpid in self.network_graph:
+            return
 
+        self.network_graph.add_node(dpid, type='switch')
+        self.switch_graph.add_node(dpid)
+        self.mst.add_node(dpid, type='switch')
+        self.topology_epoch += 1
+        self.export_topology()
 
+    def add_link(self, src, dst, src_port, dst_port):
+        """
+        Add a bidirectional switch link to the network graph.
 
-        # self.logger.info("\nUpdated network topology:\nNodes: %s\nEdges: %s\n", self.network_graph.nodes(data=True), self.network_graph.edges(data=False))
+        The broadcast tree is a maximum spanning tree weighted by link
+        capacity, updated in place: a link that joins two tree components
+        becomes a tree edge, a link that closes a cycle swaps out the lightest
+        link of the cycle if it is heavier, and whichever link is left out of
+        the tree has its ports blocked for flooding.
+        """
+        if src not in self.network_graph:
+            self.logger.warning(f"Switch {src} not found in network graph.")
+            return
+        if dst not in self.network_graph:
+            self.logger.warning(f"Switch {dst} not found in network graph.")
+            return
 
-        # Compute the Minimum Spanning Tree
-        self.mst = nx.minimum_spanning_tree(self.network_graph.to_undirected())
-        # self.logger.info("\nUpdated MST:\nEdges: %s\n", self.mst.edges(data=False))
+        # Ryu reports each direction of a link separately
+        edge_data = self.network_graph.get_edge_data(src, dst)
+        if edge_data is not None:
+            if edge_data.get('src_port') == src_port and edge_data.get('dst_port') == dst_port:
+                return
+            # the link moved to different ports, drop the stale one first
+            self.remove_link(src, dst)
+
+        # Add bidirectional edges with the correct attributes
+        self.network_graph.add_edge(src, dst, src_port=src_port, dst_port=dst_port)
+        self.network_graph.add_edge(dst, src, src_port=dst_port, dst_port=src_port)
+        self.switch_graph.add_edge(src, dst)
+        self.switch_graph.add_edge(dst, src)
+        self.map_port(src, src_port, dst)
+        self.map_port(dst, dst_port, src)
+
+        try:
+            cycle = nx.shortest_path(self.mst, src, dst)
+        except nx.NetworkXNoPath:
+            cycle = None
+        if cycle is None:
+            self.mst.add_edge(src, dst)
+            port_mods = self.unblock_link(src, dst)
+            self.refresh_tree_rules()
+        else:
+            lightest = min(zip(cycle, cycle[1:]), key=lambda link: self.link_capacity(*link))
+            if self.link_capacity(src, dst) > self.link_capacity(*lightest):
+                self.mst.remove_edge(*lightest)
+                self.mst.add_edge(src, dst)
+                port_mods = self.block_link(*lightest) + self.unblock_link(src, dst)
+                self.refresh_tree_rules()
+            else:
+                port_mods = self.block_link(src, dst)
+        self.logger.info("Broadcast tree updated with %s PortMods (%s in total)", port_mods, self.port_mods)
+
+        self.topology_epoch += 1
+        self.export_topology()
+
+    def remove_link(self, src, dst):
+        """
+        Remove a bidirectional switch link from the network graph.
 
-        # Block ports not in MST
-        for src, dst, edge_data in self.network_graph.edges(data=True):
-            if not self.mst.has_edge(src, dst) and self.network_graph.nodes[src]['type'] == 'switch':
-                self.set_port_flooding(src, edge_data['src_port'], enable=False)
-                self.blocked_ports.setdefault(src, set()).add(edge_data['src_port'])
-                # pass
+        If the link was part of the spanning tree, the heaviest link that
+        reconnects both sides is promoted into the tree, which keeps it a
+        maximum spanning tree.
+        """
+        if not self.network_graph.has_edge(src, dst):
+            return
 
+        in_tree = self.mst.has_edge(src, dst)
+        port_mods = 0 if in_tree else self.unblock_link(src, dst)
+
+        self.port_map.pop((src, self.network_graph.edges[src, dst]['src_port']), None)
+        self.port_map.pop((dst, self.network_graph.edges[dst, src]['src_port']), None)
+        self.network_graph.remove_edge(src, dst)
+        self.network_graph.remove_edge(dst, src)
+        self.switch_graph.remove_edge(src, dst)
+        self.switch_graph.remove_edge(dst, src)
+
+        if in_tree:
+            self.mst.remove_edge(src, dst)
+            component = nx.node_connected_component(self.mst, src)
+            crossing = [
+                (u, v) for u in component if u in self.switch_graph
+                for v in self.switch_graph.successors(u) if v not in component
+            ]
+            if crossing:
+                u, v = max(crossing, key=lambda link: self.link_capacity(*link))
+                self.mst.add_edge(u, v)
+                port_mods += self.unblock_link(u, v)
+            self.refresh_tree_rules()
+        self.logger.info("Broadcast tree updated with %s PortMods (%s in total)", port_mods, self.port_mods)
+
+        self.topology_epoch += 1
+        self.export_topology()
+
+    def add_host(self, mac, dpid, port_no, datapath):
+        """
+        Attach a newly learned host to its switch.
 
+        Hosts are leaves of the graph, so they never change the paths between
+        switches and only need a single tree edge: this does not bump the
+        topology epoch.
+        """
+        if mac in self.network_graph or dpid not in self.network_graph:
+            return
 
-        # draw the network graph
-        nx.draw(self.network_graph, with_labels=True, font_weight='bold')
-        plt.savefig("network_graph.png")
-        plt.close()
+        self.mac_to_switch[mac] = {'dpid': dpid, 'port': port_no, 'datapath': datapath}
+        self.network_graph.add_node(mac, type='host')
+        self.network_graph.add_edge(mac, dpid, dst_port=port_no)
+        self.network_graph.add_edge(dpid, mac, src_port=port_no)
+        self.map_port(dpid, port_no, mac)
+        self.host_ports.setdefault(dpid, set()).add(port_no)
+        self.mst.add_edge(mac, dpid)
+        self.install_tree_rules(mac)
+        self.export_topology()
+
+    def map_port(self, dpid, port_no, neighbor):
+        """
+        Record which neighbor sits behind a switch port, with the edge ids of
+        both directions of the link.
+        """
+        edge_id = self.link_state.edge_id(f"{dpid}-{neighbor}")
+        reverse_edge_id = self.link_state.edge_id(f"{neighbor}-{dpid}")
+        self.port_map[(dpid, port_no)] = (neighbor, edge_id, reverse_edge_id)
 
-        nx.draw(self.mst, with_labels=True, font_weight='bold')
-        plt.savefig("mst.png")
-        plt.close()
+    def link_capacity(self, src, dst):
+        """
+        Return the capacity of a switch link, the lower one of its two directions.
+        """
+        return min(self.link_capacities.get(f"{src}-{dst}"), self.link_capacities.get(f"{dst}-{src}"))
 
-    def set_port_flooding(self, dpid, port_no, enable):
+    def block_link(self, src, dst):
         """
-        Enable or disable flooding on a specific port of a switch.
+        Disable flooding on both ports of a switch link. Returns the number
+        of PortMods sent, ports that are already blocked or gone get none.
         """
-        datapath = self.get_datapath(dpid)
-        if not datapath:
-            self.logger.warning("Datapath for switch %s not found.", dpid)
+        port_mods = 0
+        for u, v in ((src, dst), (dst, src)):
+            port_no = self.network_graph.edges[u, v]['src_port']
+            if port_no not in self.blocked_ports.get(u, ()):
+                port_mods += self.set_port_flooding(u, port_no, enable=False)
+                self.blocked_ports.setdefault(u, set()).add(port_no)
+        self.port_mods += port_mods
+        return port_mods
+
+    def unblock_link(self, src, dst):
+        """
+        Re-enable flooding on both ports of a switch link. Returns the number
+        of PortMods sent, ports that are not blocked or gone get none.
+        """
+        port_mods = 0
+        for u, v in ((src, dst), (dst, src)):
+            port_no = self.network_graph.edges[u, v]['src_port']
+            if port_no in self.blocked_ports.get(u, ()):
+                port_mods += self.set_port_flooding(u, port_no, enable=True)
+                self.blocked_ports[u].discard(port_no)
+        self.port_mods += port_mods
+        return port_mods
+
+    def fail_links(self, links, reason):
+        """
+        Remove failed switch links and move every flow that crossed them.
+
+        A flow moves to its precomputed backup path if that survived the
+        failure, otherwise to a newly selected path. The rules of all moved
+        flows go out in one batch. Flows whose hosts are no longer connected
+        are retired.
+        """
+        start = time.time()
+        affected = set()
+        for src, dst in links:
+            if not self.switch_graph.has_edge(src, dst):
+                continue
+            affected |= self.flows_by_link.get(f"{src}-{dst}", set())
+            affected |= self.flows_by_link.get(f"{dst}-{src}", set())
+            self.remove_link(src, dst)
+        if not affected:
             return
 
+        moved = 0
+        # worst served first, so they get the first pick of the remaining capacity
+        for flow_key in sorted(affected, key=lambda k: self.flow_store[k].current_rate):
+            flow = self.flow_store[flow_key]
+            rate = flow.current_rate
+            path = flow.backup_path if self.path_alive(flow.backup_path) else None
+            if path is None:
+                try:
+                    path = self.path_selection(flow_key[0], flow_key[1])[0]
+                except nx.NetworkXException:
+                    self.set_flow_path(flow_key, [], rate)
+                    self.flow_store.remove(flow_key)
+                    self.logger.info("Flow %s has no path left (%s)", flow_key, reason)
+                    continue
+
+            self.set_flow_path(flow_key, path, rate)
+            flow.recent_rerouting_countdown = 2
+            self.install_flow(flow, path)
+            self.failovers[flow_key] = (start, rate)
+            self.stats_scheduler.mark_busy(path[0])
+            moved += 1
+
+        self.batcher.flush()
+        self.logger.info("Failed over %s flows in %.1f ms (%s)", moved, (time.time() - start) * 1000, reason)
+
+    def path_alive(self, path):
+        """
+        Return whether every switch link of a path still exists.
+        """
+        switches = path[:-1]
+        return bool(path) and all(self.switch_graph.has_edge(u, v) for u, v in zip(switches, switches[1:]))
+
+    def backup_path(self, path):
+        """
+        Return a path between the same switches sharing no link with path,
+        or an empty list if there is none.
+
+        The cached candidate paths are tried first, in order.
+        """
+        switches = path[:-1]
+        if len(switches) < 2:
+            return []
+
+        hops = list(zip(switches, switches[1:]))
+        used = set(hops) | {(v, u) for u, v in hops}
+        candidates = self.path_cache.get(self.switch_graph, switches[0], switches[-1], self.topology_epoch)
+        for candidate in candidates.paths:
+            if not any(hop in used for hop in zip(candidate, candidate[1:])):
+                return list(candidate) + [path[-1]]
+
+        # None of the k shortest paths is disjoint, search the graph without the used links
+        view = nx.restricted_view(self.switch_graph, [], used)
+        try:
+            return nx.shortest_path(view, switches[0], switches[-1]) + [path[-1]]
+        except nx.NetworkXNoPath:
+            return []
+
+    def check_recovery(self):
+        """
+        Log the time flows that were failed over took to get their throughput back.
+        """
+        now = time.time()
+        for flow_key, (start, rate) in list(self.failovers.items()):
+            flow = self.flow_store.get(flow_key)
+            if flow is None:
+                del self.failovers[flow_key]
+            elif flow.update_time > start and flow.rate.instantaneous > 0 and flow.rate.instantaneous >= RECOVERY_FRACTION * rate:
+                self.logger.info("Flow %s recovered its throughput %.2f s after the failure", flow_key, flow.update_time - start)
+                del self.failovers[flow_key]
+            elif now - start > RECOVERY_TIMEOUT:
+                self.logger.info("Flow %s did not recover its throughput within %s s", flow_key, RECOVERY_TIMEOUT)
+                del self.failovers[flow_key]
+
+    def install_tree_rules(self, mac):
+        """
+        Point the destination rules of a host along the spanning tree.
+
+        Every switch gets one rule per tree port towards the host, matching
+        the port and the host MAC. Only the rules that changed since the last
+        call are sent.
+
+        Packets entering from host ports match none of them on purpose, so
+        the first packet of every connection still reaches the controller.
+        With OpenFlow 1.0 that packet-in is the only way the controller learns
+        the 5-tuple of a connection, and the cookie-tagged ingress rules it
+        installs are what the rate estimation, the FlowRemoved retirement and
+        the choice of flows to reroute work on. Matching host ports here
+        would leave RENET nothing to reroute, so aggregate forwarding only
+        saves the transit rules of flows that stay on the tree.
+        """
+        if not AGGREGATE_FORWARDING:
+            return
+
+        rules = {}
+        for dpid, (out_port, next_hop) in self.tree_out_ports(mac).items():
+            in_ports = [
+                self.network_graph.edges[dpid, neighbor]['src_port']
+                for neighbor in self.mst.neighbors(dpid)
+                if neighbor != next_hop and self.network_graph.nodes[neighbor]['type'] == 'switch'
+            ]
+            rules[dpid] = {in_port: out_port for in_port in in_ports}
+
+        old_rules = self.tree_rules.get(mac, {})
+        for dpid in rules.keys() | old_rules.keys():
+            datapath = self.get_datapath(dpid)
+            if not datapath:
+                continue
+            new, old = rules.get(dpid, {}), old_rules.get(dpid, {})
+            parser = datapath.ofproto_parser
+            for in_port in old.keys() - new.keys():
+                self.delete_tree_rule(datapath, parser.OFPMatch(in_port=in_port, dl_dst=mac))
+            for in_port, out_port in new.items():
+                if old.get(in_port) != out_port:
+                    self.add_tree_rule(datapath, parser.OFPMatch(in_port=in_port, dl_dst=mac), out_port)
+        self.tree_rules[mac] = rules
+
+    def install_protocol_rules(self, mac, nw_proto):
+        """
+        Forward the IP traffic of a protocol without L4 ports (ICMP, ...) to
+        a host along the spanning tree, from every switch. Returns the dpids
+        rules were sent to.
+        """
+        self.protocol_rules.add((mac, nw_proto))
+        dpids = set()
+        for dpid, (out_port, next_hop) in self.tree_out_ports(mac).items():
+            datapath = self.get_datapath(dpid)
+            if datapath:
+                match = datapath.ofproto_parser.OFPMatch(dl_type=ETH_TYPE_IP, nw_proto=nw_proto, dl_dst=mac)
+                self.add_tree_rule(datapath, match, out_port)
+                dpids.add(dpid)
+        return dpids
+
+    def refresh_tree_rules(self):
+        """
+        Update the destination rules of every host after the spanning tree changed.
+        """
+        for mac in self.mac_to_switch:
+            self.install_tree_rules(mac)
+        for mac, nw_proto in self.protocol_rules:
+            self.install_protocol_rules(mac, nw_proto)
+
+    def tree_out_ports(self, mac):
+        """
+        Return {dpid: (out port, next hop)} towards a host along the spanning
+        tree, for every switch connected to it.
+        """
+        out_ports = {}
+        if mac in self.mst:
+            for node, path in nx.single_source_shortest_path(self.mst, mac).items():
+                if len(path) < 2 or self.network_graph.nodes[node]['type'] != 'switch':
+                    continue
+                out_ports[node] = (self.network_graph.edges[node, path[-2]]['src_port'], path[-2])
+        return out_ports
+
+    def tree_path(self, src, dst):
+        """
+        Return the spanning tree path from the switch of host src to host dst,
+        in the same form as path_selection, or None if there is none.
+        """
+        try:
+            return nx.shortest_path(self.mst, self.mac_to_switch[src]['dpid'], dst)
+        except nx.NetworkXNoPath:
+            return None
+
+    def export_topology(self):
+        """
+        Schedule a snapshot of the network graph and the spanning tree.
+        """
+        if self.snapshot_exporter is not None:
+            self.snapshot_exporter.mark_dirty(self.network_graph, self.mst, self.topology_epoch)
+
+    def set_port_flooding(self, dpid, port_no, enable):
+        """
+        Enable or disable flooding on a specific port of a switch. Returns
+        False if no PortMod was sent because the switch or the port is gone.
+        """
+        # Not get_datapath, a switch that left is expected here and not worth a warning
+        datapath = self.datapaths.get(dpid)
+        if not datapath or port_no not in datapath.ports:
+            # Ryu drops a deleted port from datapath.ports before the port status reaches the app
+            self.logger.debug("Port %s of switch %s is gone, flooding not changed", port_no, dpid)
+            return False
+
         parser = datapath.ofproto_parser
         ofproto = datapath.ofproto
 
@@ -194,81 +605,159 @@ class RENETController(app_manager.RyuApp):
             config=config,
             mask=mask
         )
-        datapath.send_msg(mod)
+        self.batcher.send(datapath, mod)
         state = "enabled" if enable else "disabled"
         # self.logger.info(f"Flooding {state} on port {port_no} of switch {dpid}.")
+        return True
 
 
     def _send_stats_request(self, datapath):
-        """Send a periodic stats request to the controller for flow and link metrics."""
+        """Send a stats request to a switch for flow and link metrics."""
         ofproto = datapath.ofproto
         parser = datapath.ofproto_parser
 
-        while True:
-            # Send Flow Stats Request
-            # flow_stats_req = parser.OFPStatsRequest(datapath, flags=0)
-            empty_match = parser.OFPMatch()
-            flow_stats_req = parser.OFPFlowStatsRequest(datapath, flags=0, match=empty_match, table_id=0, out_port=ofproto.OFPP_NONE)
-            datapath.send_msg(flow_stats_req)
-            # self.logger.info("Sent flow stats request to datapath %s", datapath.id)
-
-            # Send Port Stats Request
-            port_stats_req = parser.OFPPortStatsRequest(datapath, flags=0, port_no=ofproto.OFPP_NONE)
-            datapath.send_msg(port_stats_req)
-            # self.logger.info("Sent port stats request to datapath %s", datapath.id)
-
-            rerun = False
-
-            for flow_key, flow_info in self.flow_store.items():
-                if flow_info['active']:
-                    flow_info['active_countdown'] -= 1
-                    if flow_info['active_countdown'] == 0 and flow_info['active']:
-                        flow_info['active'] = False
-                        rerun = True
-
-                        self.logger.info("Flow %s marked as inactive", flow_key)
-            
-            if rerun:
-                to_rerun = {}
-                for flow_key, flow_info in self.flow_store.items():
-                    if flow_info['active'] and flow_info['recent_rerouting_countdown'] == 0 and flow_info['current_rate'] < 0.75 * DESIRED_RATE:
-                        to_rerun[flow_key] = flow_info['current_rate'] / DESIRED_RATE
-                
-                sorted_rerun = sorted(to_rerun.items(), key=lambda x: x[1])
-
-                for flow_key, _ in sorted_rerun:
-                    if flow_key[0] not in self.network_graph or flow_key[1] not in self.network_graph:
-                        continue
-                    path, throughput = self.path_selection(flow_key[0], flow_key[1])
-                    if throughput > self.flow_store[flow_key]['current_rate'] * 1.25:
-                        self.flow_store[flow_key]['recent_rerouting_countdown'] = 2
-                        # decrement the flow count for the old path
-                        for i in range(len(self.flow_store[flow_key]['path']) - 2):
-                            self.flows_per_link[f'{self.flow_store[flow_key]["path"][i]}-{self.flow_store[flow_key]["path"][i + 1]}'] -= 1
-                            self.flows_per_link[f'{self.flow_store[flow_key]["path"][i + 1]}-{self.flow_store[flow_key]["path"][i]}'] -= 1
-                        
-                        # increment the flow count for the new path
-                        for i in range(len(path) - 2):
-                            self.flows_per_link[f'{path[i]}-{path[i + 1]}'] += 1
-                            self.flows_per_link[f'{path[i + 1]}-{path[i]}'] += 1
-                        
-                        self.flow_store[flow_key]['path'] = path
-
-                        src, dst, src_port, dst_port = flow_key
-
-                        self.install_path_flows(path, src, dst, src_port, dst_port)
-                        # self.install_path_flows(path[::-1], dst, src, src_port, dst_port)
-
-                        print(f"Rerouting flow from {src} to {dst}: {path} (Flow Left)")
-
-
-
-
-                
-
-
-            # Sleep for the interval before sending the next request
-            time.sleep(self.stats_interval)
+        requests = []
+
+        # Send Flow Stats Requests, only for the ingress rules of flows entering from a host port.
+        # The ingress rule is the only one matching on in_port, so transit rules are left out of the reply.
+        for port_no in self.host_ports.get(datapath.id, ()):
+            match = parser.OFPMatch(in_port=port_no)
+            requests.append(parser.OFPFlowStatsRequest(datapath, flags=0, match=match, table_id=0, out_port=ofproto.OFPP_NONE))
+
+        # Send Port Stats Request
+        requests.append(parser.OFPPortStatsRequest(datapath, flags=0, port_no=ofproto.OFPP_NONE))
+
+        # Send Aggregate Stats Request, for the number of rules in the flow table
+        requests.append(parser.OFPAggregateStatsRequest(
+            datapath, flags=0, match=parser.OFPMatch(), table_id=0xff, out_port=ofproto.OFPP_NONE))
+
+        for req in requests:
+            self.batcher.send(datapath, req)
+            self.stats_traffic['requests'] += 1
+            self.stats_traffic['request_bytes'] += len(req.buf)
+
+    def count_stats_reply(self, msg):
+        """Count a stats reply in the control channel traffic."""
+        self.stats_traffic['replies'] += 1
+        self.stats_traffic['reply_bytes'] += len(msg.buf)
+
+    def _stats_cycle(self):
+        """Report the stats counters once per stats interval."""
+        self.logger.debug("Path cache stats: %s", self.path_cache.stats())
+        self.logger.info("Stats traffic: %s, polling: %s", self.stats_traffic, self.stats_scheduler.stats())
+        self.logger.info("Message batching: %s", self.batcher.stats())
+        self.logger.info("Flow table rules: %s (per switch: %s), packet-ins: %s",
+                         sum(self.rule_counts.values()), self.rule_counts, self.packet_in_counts)
+        self.logger.info("ARP table: %s", self.arp_table.stats())
+
+    @set_ev_cls(ofp_event.EventOFPFlowRemoved, MAIN_DISPATCHER)
+    def flow_removed_handler(self, ev):
+        """
+        Retire a flow when its ingress rule expired, and reroute the remaining flows.
+        """
+        msg = ev.msg
+        flow = self.flow_store.by_cookie(msg.cookie)
+        # Only the ingress rule asks for removal messages, but a transit rule may share its cookie after a reroute
+        if flow is None or not flow.path or flow.path[0] != msg.datapath.id:
+            return
+
+        self.set_flow_path(flow.key, [], flow.current_rate)
+        self.flow_store.remove(flow.key)
+        self.logger.info("Flow %s removed after %ss", flow.key, msg.duration_sec)
+        self.reroute_slow_flows("Flow Left")
+
+    def reroute_slow_flows(self, reason):
+        """
+        Reroute the active flows that get less than 75% of the desired rate.
+        """
+        to_rerun = [
+            flow for flow in self.flow_store.active()
+            if flow.recent_rerouting_countdown == 0 and flow.current_rate < 0.75 * DESIRED_RATE
+        ]
+        sorted_rerun = sorted(to_rerun, key=lambda flow: flow.current_rate / DESIRED_RATE)
+        self.reroute_flows([flow.key for flow in sorted_rerun], reason)
+
+    def reroute_flows(self, flow_keys, reason, min_gain=1.25):
+        """
+        Reroute a batch of flows jointly, in the given order.
+
+        Each flow is taken off its current path before its candidates are
+        scored, and its rate is moved onto the chosen path right away, so the
+        following decisions see the load of the earlier ones instead of
+        herding onto the same link. A flow only moves if the new path is
+        different and expected to give it min_gain times its current rate.
+        If min_gain is None no gain is required, any different path is
+        taken even if it scores below the current rate. Once every flow has
+        been assigned, each move is installed by its own reroute transaction.
+        """
+        moves = []
+        old_paths = {}
+        for flow_key in flow_keys:
+            src, dst, src_port, dst_port = flow_key
+            if src not in self.mac_to_switch or dst not in self.mac_to_switch:
+                continue
+
+            flow = self.flow_store[flow_key]
+            old_path = flow.path
+            rate = flow.current_rate
+
+            # score the candidates without the flow's own load
+            self.count_path_flows(old_path, -1, rate)
+            path, throughput = self.path_selection(src, dst)
+            self.count_path_flows(old_path, 1, rate)
+
+            if path != old_path and (min_gain is None or throughput > rate * min_gain):
+                self.set_flow_path(flow_key, path, rate)
+                flow.recent_rerouting_countdown = 2
+                moves.append(flow_key)
+                old_paths[flow_key] = old_path
+
+        for flow_key in moves:
+            src, dst, src_port, dst_port = flow_key
+            path = self.flow_store[flow_key].path
+            print(f"Rerouting flow from {src} to {dst}: {path} ({reason})")
+            hub.spawn(self.reroute_transaction, flow_key, old_paths[flow_key], path)
+
+        return moves
+
+    def reroute_transaction(self, flow_key, old_path, new_path):
+        """
+        Move a flow to a new path without sending its packets into missing rules.
+
+        The rules of the new path are installed from the egress towards the
+        ingress and confirmed with barriers before the ingress rule is flipped,
+        then the rules left on switches of the old path only are deleted. Both
+        directions of a bidirectional flow move together.
+        """
+        start = time.time()
+        src, dst, src_port, dst_port = flow_key
+        flow = self.flow_store.get(flow_key)
+        if flow is None:
+            return
+
+        datapaths = self.install_flow(flow, new_path, ingress=False)
+        confirmed = self.barriers.wait(datapaths)
+
+        ingress = self.install_flow(flow, new_path, transit=False)
+        confirmed = self.barriers.wait(ingress) and confirmed
+
+        # The flow may have been moved again or retired in the meantime
+        current_path = flow.path if self.flow_store.get(flow_key) is flow else []
+        for dpid in old_path[1:-1]:
+            if dpid in new_path or dpid in current_path:
+                continue
+            datapath = self.get_datapath(dpid)
+            if datapath:
+                self.delete_flow(datapath, src, dst, src_port, dst_port, nw_proto=flow.ip_proto)
+                if BIDIRECTIONAL_FLOWS:
+                    self.delete_flow(datapath, dst, src, dst_port, src_port, nw_proto=flow.ip_proto)
+
+        self.logger.info("Rerouted flow %s to %s in %.1f ms%s", flow_key, new_path,
+                         (time.time() - start) * 1000, "" if confirmed else " (unconfirmed)")
+
+    @set_ev_cls(ofp_event.EventOFPBarrierReply, MAIN_DISPATCHER)
+    def barrier_reply_handler(self, ev):
+        self.barriers.reply(ev.msg)
 
     @set_ev_cls(ofp_event.EventOFPFlowStatsReply, MAIN_DISPATCHER)
     def _flow_stats_reply_handler(self, ev):
@@ -276,30 +765,20 @@ class RENETController(app_manager.RyuApp):
         datapath = ev.msg.datapath
         body = ev.msg.body
 
-        for stat in body:
-            # Flow store stores source, destination, current path, rate, and other metrics
-            flow_key = (mac.haddr_to_str(stat.match.dl_src), mac.haddr_to_str(stat.match.dl_dst), stat.match.tp_src, stat.match.tp_dst)
-            # print the whol match
-            # print("Match:", stat.match)
-            prev_flow_info = self.flow_store.get(flow_key, {})
-            if prev_flow_info == {}:
-                prev_flow_info['path'] = []
-            
-            new_flow_info = {
-                'src_dst': flow_key,
-                # 'current_path': self.flow_store.get(flow_key, {}).get('current_path', []), # Retrieve the real path from flow store
-                # 'current_rate': (stat.byte_count - prev_flow_info['recieved_bytes']) / self.stats_interval,
-                'current_rate': stat.byte_count / stat.duration_sec if stat.duration_sec > 0 else 0,
-                'desired_rate': DESIRED_RATE,  # 1 Mbps
-                'update_time': time.time(),
-                'active': True,  # Assuming flow is active if stats exist
-                'input_port': stat.match.in_port,
-                'active_countdown': 2,
-                'recent_rerouting_countdown': 0,
-                'path': prev_flow_info['path']
-            }
-            self.flow_store[flow_key] = new_flow_info
-            # self.logger.info("Updated flow stats for %s: %s", flow_key, new_flow_info)
+        self.count_stats_reply(ev.msg)
+
+        # Flow store stores source, destination, current path, rate, and other metrics
+        changed = self.flow_store.update_from_stats(datapath.id, body, RATE_CHANGE_THRESHOLD)
+        if changed:
+            self.stats_scheduler.mark_busy(datapath.id)
+        if self.failovers:
+            self.check_recovery()
+
+    @set_ev_cls(ofp_event.EventOFPAggregateStatsReply, MAIN_DISPATCHER)
+    def _aggregate_stats_reply_handler(self, ev):
+        """Record the number of rules in the flow table of the switch."""
+        self.count_stats_reply(ev.msg)
+        self.rule_counts[ev.msg.datapath.id] = ev.msg.body.flow_count
 
     @set_ev_cls(ofp_event.EventOFPPortStatsReply, MAIN_DISPATCHER)
     def _port_stats_reply_handler(self, ev):
@@ -307,90 +786,105 @@ class RENETController(app_manager.RyuApp):
         datapath = ev.msg.datapath
         body = ev.msg.body
 
+        self.count_stats_reply(ev.msg)
+
+        dpid1 = datapath.id
+        now = time.time()
+        busy = False
         for stat in body:
-            # Find the connected switch for the given port
-            dpid1 = datapath.id
-            port_no = stat.port_no
-            dpid2 = None
-            for neighbor in self.network_graph.neighbors(dpid1):
-                edge_data = self.network_graph.get_edge_data(dpid1, neighbor)
-                if 'src_port' in edge_data and edge_data['src_port'] == port_no:
-                    dpid2 = neighbor
-                    break
-                elif 'dst_port' in edge_data and edge_data['dst_port'] == port_no:
-                    dpid2 = neighbor
-                    break
-
-            if dpid2 is None:
-                # raise ValueError(f"Neighbor switch not found for port {port_no} on switch {dpid1}")
+            # Find the neighbor connected to the given port
+            neighbor = self.port_map.get((dpid1, stat.port_no))
+            if neighbor is None:
                 continue
+            dpid2, edge_id, reverse_edge_id = neighbor
+
+            # Polls are jittered, so measure usage over the time since the last reply for this port
+            prev_time, prev_rx_bytes = self.port_counters.get((dpid1, stat.port_no), (now, stat.rx_bytes))
+            self.port_counters[(dpid1, stat.port_no)] = (now, stat.rx_bytes)
 
             # Link store stores source, destination, current rate, and other metrics
             link_key = f"{dpid1}-{dpid2}"
-            prev_link_info = self.link_store.get(link_key, {}).copy()
-
-            if prev_link_info == {}:
-                prev_link_info['recieved_bytes'] = 0
-                prev_link_info['current_bandwidth'] = 0
-
-            prev_bandwidth = prev_link_info['current_bandwidth']
-
             new_link_info = {
                 'src_dst': link_key,
-                'usage': (stat.rx_bytes - prev_link_info['recieved_bytes']) / self.stats_interval,
+                'usage': (stat.rx_bytes - prev_rx_bytes) / (now - prev_time) if now > prev_time else 0,
                 'recieved_bytes': stat.rx_bytes,
                 'desired_rate': 1000000,  # 1 Mbps
-                'update_time': time.time(),
+                'update_time': now,
                 'active': True,  # Assuming link is active if stats exist
             }
 
-            with open('/mn_scripts/link_bandwidths.json', 'r') as f:
-                current_link_bandwidths = json.load(f)
-                link_key = f"{dpid1}-{dpid2}"
-                link_key2 = f"{dpid2}-{dpid1}"
-                new_link_info['current_bandwidth'] = current_link_bandwidths.get(link_key, 0)
-                if new_link_info['current_bandwidth'] < prev_bandwidth:
-                    # iterate though the flow store and get the ones that are using this link
-                    for flow_key, flow_info in self.flow_store.items():
-                        if self.edge_in_path(flow_info['path'], dpid1, dpid2):
-                            path, throughput = self.path_selection(flow_key[0], flow_key[1])
-
-                            self.flow_store[flow_key]['recent_rerouting_countdown'] = 2
-                            # decrement the flow count for the old path
-                            for i in range(len(flow_info['path']) - 2):
-                                self.flows_per_link[f'{flow_info["path"][i]}-{flow_info["path"][i + 1]}'] -= 1
-                                self.flows_per_link[f'{flow_info["path"][i + 1]}-{flow_info["path"][i]}'] -= 1
-                            
-                            # increment the flow count for the new path
-                            for i in range(len(path) - 2):
-                                self.flows_per_link[f'{path[i]}-{path[i + 1]}'] += 1
-                                self.flows_per_link[f'{path[i + 1]}-{path[i]}'] += 1
-                            
-                            self.flow_store[flow_key]['path'] = path
-
-                            src, dst, src_port, dst_port = flow_key
-
-                            print(f"Rerouting flow from {src} to {dst}: {path} (Link Bandwidthd Decreased)")
-
-                            self.install_path_flows(path, src, dst, src_port, dst_port)
-                            # self.install_path_flows(path[::-1], dst, src, src_port, dst_port)
-                            # self.logger.info("Rerouted flow %s to path %s", flow_key, path)
-                            break
+            link_key2 = f"{dpid2}-{dpid1}"
+            new_link_info['current_bandwidth'] = self.link_capacities.get(link_key)
 
             self.link_store[link_key] = new_link_info
             self.link_store[link_key2] = new_link_info
+            self.link_state.update_edge(edge_id, new_link_info['current_bandwidth'], new_link_info['usage'])
+            self.link_state.update_edge(reverse_edge_id, new_link_info['current_bandwidth'], new_link_info['usage'])
             # self.logger.info("Updated port stats for %s: %s", link_key, new_link_info)
 
-    def edge_in_path(self, path, n1, n2):
+            # Capacities are in Mbps, usage in bytes per second
+            capacity = new_link_info['current_bandwidth'] * 1000000 / 8
+            if capacity and new_link_info['usage'] > HOT_LINK_UTILIZATION * capacity:
+                busy = True
+
+        if busy:
+            self.stats_scheduler.mark_busy(dpid1)
+
+    def _watch_link_capacities(self):
+        """
+        Reload the link capacities when the bandwidth file changes and publish
+        an event for every link whose capacity changed.
+        """
+        while True:
+            for link_key, (old_capacity, new_capacity) in self.link_capacities.reload().items():
+                self.send_event_to_observers(EventLinkCapacityChanged(link_key, old_capacity, new_capacity))
+            hub.sleep(CAPACITY_POLL_INTERVAL)
+
+    @set_ev_cls(EventLinkCapacityChanged)
+    def link_capacity_changed_handler(self, ev):
+        """
+        Update the link state and reroute the flows of a link whose capacity dropped.
+        """
+        link_info = self.link_store.get(ev.link_key)
+        if link_info is not None:
+            link_info['current_bandwidth'] = ev.new_capacity
+        self.link_state.set_link(ev.link_key, capacity=ev.new_capacity)
+
+        if ev.new_capacity < ev.old_capacity:
+            # reroute every flow using this link, worst served first
+            affected = sorted(self.flows_by_link.get(ev.link_key, ()), key=lambda k: self.flow_store[k].current_rate)
+            self.reroute_flows(affected, "Link Bandwidth Decreased", min_gain=None)
+
+    def set_flow_path(self, flow_key, path, rate=0):
+        """
+        Assign a path to a flow, moving its flow count, rate and link index
+        entries from its previous path.
+        """
+        flow = self.flow_store[flow_key]
+        old_path = flow.path
+
+        self.count_path_flows(old_path, -1, rate)
+        for link_key in self.path_link_keys(old_path):
+            flows = self.flows_by_link.get(link_key)
+            if flows is not None:
+                flows.discard(flow_key)
+
+        self.count_path_flows(path, 1, rate)
+        for link_key in self.path_link_keys(path):
+            self.flows_by_link.setdefault(link_key, set()).add(flow_key)
+
+        flow.path = path
+        flow.backup_path = self.backup_path(path) if path else []
+
+    def path_link_keys(self, path):
         """
-        Check if an edge is in a given path.
+        Return the keys of both directions of every switch link on a path.
         """
-        for i in range(len(path) - 1):
-            if path[i] == n1 and path[i + 1] == n2:
-                return True
-            if path[i] == n2 and path[i + 1] == n1:
-                return True
-        return False
+        keys = []
+        for i in range(len(path) - 2):
+            keys.append(f'{path[i]}-{path[i + 1]}')
+            keys.append(f'{path[i + 1]}-{path[i]}')
+        return keys
 
     @set_ev_cls(ofp_event.EventOFPPacketIn, MAIN_DISPATCHER)
     def packet_in_handler(self, ev):
@@ -400,139 +894,165 @@ class RENETController(app_manager.RyuApp):
         msg = ev.msg
         datapath = msg.datapath
         in_port = msg.in_port
-        pkt = packet.Packet(msg.data)
-        eth = pkt.get_protocols(ethernet.ethernet)[0]
+        headers = packet_parser.parse(msg.data)
+        if headers is None:
+            return
 
-        src = eth.src
-        dst = eth.dst
+        src = headers.src
+        dst = headers.dst
         dpid = datapath.id
-
-        print("Packet in: ", src, "->", dst, "on switch", dpid, "port", in_port)
-
-
+        self.packet_in_counts['packet_ins'] += 1
 
         # Ignore LLDP packets
-        if eth.ethertype == 0x88cc:# or eth.ethertype == 0x86DD:
+        if headers.ethertype == 0x88cc:# or headers.ethertype == 0x86DD:
             return
 
-        # don't show packets with type 34525
-
-        if eth.ethertype != 34525:
-            print(f"Packet in: {src} -> {dst} on switch {dpid} port {in_port} of type {eth.ethertype}")
-        
-
-        # Learn the source host's switch and port
-        self.mac_to_switch[src] = {'dpid': dpid, 'port': in_port, 'datapath': datapath}
+        self.logger.debug("Packet in: %s -> %s on switch %s port %s of type %s", src, dst, dpid, in_port, headers.ethertype)
 
-        
-
-        # Add the source host to the graph if not already present
+        # Learn the source host's switch and port, and add it to the graph if not already present
         if src not in self.network_graph:
-            # self.network_graph.add_node(src, type='host')
-            # self.network_graph.add_edge(src, dpid, dst_port=in_port)
-            # self.network_graph.add_edge(dpid, src, src_port=in_port)
-            # self.logger.info(f"Added host {src} connected to switch {dpid} via port {in_port}")
-            self.update_topology()
-            
+            self.add_host(src, dpid, in_port, datapath)
+        if src in self.mac_to_switch:
+            self.arp_table.learn(headers.src_ip, src)
+
+        if ARP_PROXY and headers.arp_op == ARP_REQUEST and self.answer_arp(datapath, in_port, headers):
+            return
         
         # Log the current state of the network graph
         # self.logger.info("Current network graph nodes: %s", self.network_graph.nodes(data=True))
         # self.logger.info("Current network graph edges: %s", self.network_graph.edges(data=True))
 
         # Check if the destination is known
-        if dst in self.mac_to_switch:
+        if dst in self.mac_to_switch and src in self.mac_to_switch:
             # Compute path and install flow rules
             # src_dpid = self.mac_to_switch[src]['dpid']
             # dst_dpid = self.mac_to_switch[dst]['dpid']
             # path = nx.shortest_path(self.network_graph, src, dst)
 
-            # Extract TCP/UDP ports if available
-            tcp_pkt = pkt.get_protocol(tcp.tcp)
-            udp_pkt = pkt.get_protocol(udp.udp)
-            if tcp_pkt:
-                src_port = tcp_pkt.src_port
-                dst_port = tcp_pkt.dst_port
-            elif udp_pkt:
-                src_port = udp_pkt.src_port
-                dst_port = udp_pkt.dst_port
-            else:
-                # Flood the packet to discover the destination
-                self.logger.info(f"Flooding packet")
+            if headers.ethertype == ETH_TYPE_ARP:
+                # Unicast ARP goes straight to the host instead of being flooded
+                self.send_to_host(dst, msg.data)
+                return
+            if headers.ethertype != ETH_TYPE_IP:
+                self.logger.debug("Flooding packet")
+                self.flood_packet_mst(datapath, in_port, msg)
+                return
+
+            # TCP/UDP ports, if available
+            src_port = headers.src_port
+            dst_port = headers.dst_port
+            if src_port is None and headers.ip_proto in (IPPROTO_TCP, IPPROTO_UDP):
+                # Fragment without L4 header, a protocol rule would capture every new flow
                 self.flood_packet_mst(datapath, in_port, msg)
                 return
-            
-            print("Src-port", src_port, "Dst-port", dst_port)
-            
-            path = self.path_selection(src, dst)[0]
+            if src_port is None:
+                # ICMP and other IP traffic follows destination rules along the spanning tree
+                if dpid not in self.install_protocol_rules(dst, headers.ip_proto):
+                    # No tree path from this switch to the host, the packet would miss the table again
+                    self.flood_packet_mst(datapath, in_port, msg)
+                    return
+                actions = [datapath.ofproto_parser.OFPActionOutput(datapath.ofproto.OFPP_TABLE)]
+                self.send_packet(datapath, msg.buffer_id, in_port, actions, msg.data)
+                return
+
+            flow_key = (src, dst, src_port, dst_port)
+            reverse_key = (dst, src, dst_port, src_port)
+            for key in (flow_key, reverse_key):
+                if key in self.pending_setups:
+                    # The rules of this flow are not confirmed yet, send the packet once they are
+                    self.pending_setups[key].append((datapath, msg.buffer_id, in_port, msg.data))
+                    self.packet_in_counts['duplicates'] += 1
+                    return
+
+            out_port = datapath.ofproto.OFPP_TABLE
+            if BIDIRECTIONAL_FLOWS and reverse_key in self.flow_store:
+                # Reverse direction of a known flow, its rules expired while the forward ones are still hit
+                flow = self.flow_store[reverse_key]
+                if dpid not in flow.path[:-1]:
+                    self.flood_packet_mst(datapath, in_port, msg)
+                    return
+                datapaths = self.install_flow(flow, flow.path, forward=False)
+                self.pending_setups[reverse_key] = [(datapath, msg.buffer_id, in_port, msg.data)]
+                hub.spawn(self.commit_setup, reverse_key, datapaths)
+                return
+
+            # In aggregate mode a new flow follows the spanning tree, it only needs its ingress rules
+            path = self.tree_path(src, dst) if AGGREGATE_FORWARDING else None
+            transit = path is None
+            if path is None:
+                path = self.path_selection(src, dst)[0]
+
+            if flow_key not in self.flow_store:
+                self.packet_in_counts['flow_setups'] += 1
+            flow = self.flow_store.add(flow_key, in_port, headers.ip_proto)
 
             self.logger.info(f"Path computed from {src} to {dst}: {path}")
-            self.install_path_flows(path, src, dst, src_port, dst_port)
-            # self.install_path_flows(path[::-1], dst, src, src_port, dst_port)
-            for i in range(len(path) - 2):
-                self.flows_per_link[f'{path[i]}-{path[i + 1]}'] += 1
-                self.flows_per_link[f'{path[i + 1]}-{path[i]}'] += 1
+            datapaths = self.install_flow(flow, path, transit=transit)
+
+            self.set_flow_path(flow_key, path)
             # send packet
-            out_port = datapath.ofproto.OFPP_TABLE
             actions = [datapath.ofproto_parser.OFPActionOutput(out_port)]
             self.send_packet(datapath, msg.buffer_id, in_port, actions, msg.data)
+
+            self.pending_setups[flow_key] = []
+            hub.spawn(self.commit_setup, flow_key, datapaths)
             return
         else:
             # Flood the packet to discover the destination
-            self.logger.info(f"Flooding packet")
+            self.logger.debug("Flooding packet")
             self.flood_packet_mst(datapath, in_port, msg)
             return
         
 
 
+    def commit_setup(self, flow_key, datapaths):
+        """
+        Wait until the switches confirmed the rules of a new flow, then send
+        the packets of the flow that reached the controller in the meantime
+        back through the flow table.
+        """
+        self.barriers.wait(datapaths)
+        for datapath, buffer_id, in_port, data in self.pending_setups.pop(flow_key, ()):
+            actions = [datapath.ofproto_parser.OFPActionOutput(datapath.ofproto.OFPP_TABLE)]
+            self.send_packet(datapath, buffer_id, in_port, actions, data)
+            self.packet_in_counts['released'] += 1
+
     def path_selection(self, src, dst):
         """
-        Compute the optimal path between two switches, considering link capacities and flow requirements.
-        """
-        # Get K shortest paths
-        K = 10  # Number of shortest paths to consider
-        paths = list(nx.shortest_simple_paths(self.network_graph, source=src, target=dst))
-        paths = paths[:K]  # Limit to K shortest paths
-
-
-        path_list = {}
-
-        for path in paths:
-            # remove the first and last element of the path
-            path = path[1:-1]
-            # Calculate the minimum bandwidth along this path
-            path_throughput = float('inf')
-            for i in range(len(path) - 1):
-                link = self.link_store[f'{path[i]}-{path[i + 1]}']
-                link_capacity = link['current_bandwidth']
-                link_usage = link['usage']
-                available_bandwidth = link_capacity - link_usage
-                fair_share = link_capacity / (self.flows_per_link[f'{path[i]}-{path[i + 1]}'] + 1)
-                expected_throughput = max(available_bandwidth, fair_share)
-                if expected_throughput < path_throughput:
-                    path_throughput = expected_throughput
-            path_list[tuple(path)] = path_throughput
-        
-        path_list = sorted(path_list.items(), key=lambda x: x[1])
+        Compute the optimal path between two hosts, considering link capacities and flow requirements.
+
+        Candidate paths are computed on the switch-only graph between the
+        switches the hosts are attached to, so all host pairs behind the same
+        pair of switches share them. The destination host is appended last.
+        """
+        src_dpid = self.mac_to_switch[src]['dpid']
+        dst_dpid = self.mac_to_switch[dst]['dpid']
 
-        path_result = None
-        throughput_result = None
+        # Get K shortest paths, only recomputed when the topology changes
+        candidates = self.path_cache.get(self.switch_graph, src_dpid, dst_dpid, self.topology_epoch)
 
-        for path, throughput in path_list:
-            if throughput > DESIRED_RATE:
-                self.logger.info(f"Selected path from {src} to {dst}: {path}")
-                path_result = path
-                throughput_result = throughput
-                break
+        # Bottleneck throughput of every candidate path in one vectorized pass
+        throughputs = self.link_state.score(candidates.incidence)
 
-        if path_result is None:
-            path_result, throughput_result = path_list[-1]
-            self.logger.info(f"Selected path from {src} to {dst}: {path_result}") 
+        # Pick the least loaded path that still meets the desired rate, or the best one otherwise
+        order = np.argsort(throughputs, kind='stable')
+        satisfied = throughputs[order] > DESIRED_RATE
+        best = order[np.argmax(satisfied)] if satisfied.any() else order[-1]
 
+        path_result = candidates.paths[best]
+        throughput_result = float(throughputs[best])
+        self.logger.info(f"Selected path from {src} to {dst}: {path_result}")
 
-        
         return list(path_result) + [dst], throughput_result
-    
 
+    def count_path_flows(self, path, delta, rate=0):
+        """
+        Add delta to the flow count of both directions of every switch link on
+        a path, and delta times rate to their usage.
+        """
+        switches = path[:-1]
+        self.link_state.add_flows(self.link_state.path_edges(switches), delta, rate)
+        self.link_state.add_flows(self.link_state.path_edges(switches[::-1]), delta, rate)
 
     def flood_packet_mst(self, datapath, in_port, msg):
         """
@@ -546,12 +1066,76 @@ class RENETController(app_manager.RyuApp):
         actions = [datapath.ofproto_parser.OFPActionOutput(ofproto.OFPP_FLOOD)]
         self.send_packet(datapath, msg.buffer_id, in_port, actions, msg.data)
 
+    def answer_arp(self, datapath, in_port, headers):
+        """
+        Reply to an ARP request of a host from its own switch, if the target
+        is a known host. Returns False if the request has to be flooded.
+        """
+        host = self.mac_to_switch.get(headers.src)
+        if host is None or host['dpid'] != datapath.id or host['port'] != in_port:
+            # A copy flooded by another switch, the switch of the requester already handled it
+            return False
+
+        target_mac = self.arp_table.lookup(headers.dst_ip)
+        if target_mac is None or target_mac not in self.mac_to_switch:
+            return False
+
+        ofproto = datapath.ofproto
+        data = arp_reply(headers.src, headers.src_ip, target_mac, headers.dst_ip)
+        actions = [datapath.ofproto_parser.OFPActionOutput(in_port)]
+        self.send_packet(datapath, ofproto.OFP_NO_BUFFER, ofproto.OFPP_NONE, actions, data)
+        return True
+
+    def send_to_host(self, mac, data):
+        """
+        Send a packet out of the switch port a known host is attached to.
+        """
+        host = self.mac_to_switch[mac]
+        # The datapath cached with the host is stale once its switch reconnected
+        datapath = self.get_datapath(host['dpid'])
+        if not datapath:
+            return
+        ofproto = datapath.ofproto
+        actions = [datapath.ofproto_parser.OFPActionOutput(host['port'])]
+        self.send_packet(datapath, ofproto.OFP_NO_BUFFER, ofproto.OFPP_NONE, actions, data)
+
+
+    def install_flow(self, flow, path, ingress=True, transit=True, forward=True):
+        """
+        Install the rules of a flow along its path, and along the reverse path
+        with REVERSE_COOKIE set if BIDIRECTIONAL_FLOWS is on.
 
-    def install_path_flows(self, path, src, dst, tp_src, tp_dst):
+        Leaving out ingress or transit installs only the transit rules or only
+        the ingress rules, leaving out forward only the reverse direction.
+        Returns the datapaths rules were sent to.
+        """
+        src, dst, src_port, dst_port = flow.key
+        directions = [(path, src, dst, src_port, dst_port, flow.cookie)] if forward else []
+        if BIDIRECTIONAL_FLOWS:
+            reverse_path = path[-2::-1] + [src]
+            directions.append((reverse_path, dst, src, dst_port, src_port, flow.cookie | REVERSE_COOKIE))
+
+        datapaths = []
+        for hops, hop_src, hop_dst, tp_src, tp_dst, rule_cookie in directions:
+            if not transit:
+                hops = hops[:2]
+            first_hop = 0 if ingress else 1
+            datapaths += self.install_path_flows(
+                hops, hop_src, hop_dst, tp_src, tp_dst, rule_cookie, first_hop, flow.ip_proto)
+        return datapaths
+
+    def install_path_flows(self, path, src, dst, tp_src, tp_dst, cookie=0, first_hop=0, nw_proto=6):
         """
-        Install flow rules for each switch along the path.
+        Install flow rules for each switch along the path, starting from the
+        hop at index first_hop.
+
+        Rules are sent from the egress towards the ingress. The rule on the
+        first switch also matches the port of the source host, which tells it
+        apart from transit rules when polling flow stats. Returns the
+        datapaths rules were sent to.
         """
-        for i in range(len(path) - 1):
+        datapaths = []
+        for i in reversed(range(first_hop, len(path) - 1)):
             curr_node = path[i]
             next_node = path[i + 1]
 
@@ -566,10 +1150,14 @@ class RENETController(app_manager.RyuApp):
                 # next node is a switch or host, so the output port is the one connected to the next switch
                 out_port = self.network_graph.edges[curr_node, next_node]['src_port']
 
+            in_port = self.mac_to_switch[src]['port'] if i == 0 else None
+
             # Install flow rule on the current switch
             datapath = self.get_datapath(curr_node)
             if datapath:
-                self.add_flow(datapath, src, dst, tp_src, tp_dst, out_port)
+                self.add_flow(datapath, src, dst, tp_src, tp_dst, out_port, cookie, in_port, nw_proto)
+                datapaths.append(datapath)
+        return datapaths
 
 
     def send_packet(self, datapath, buffer_id, in_port, actions, data=None):
@@ -585,28 +1173,91 @@ class RENETController(app_manager.RyuApp):
             actions=actions,
             data=data
         )
-        datapath.send_msg(out)
+        self.batcher.send(datapath, out)
 
 
-    def add_flow(self, datapath, src, dst, tp_src, tp_dst, out_port):
+    def add_flow(self, datapath, src, dst, tp_src, tp_dst, out_port, cookie=0, in_port=None, nw_proto=6):
         """
         Add a flow rule to the given datapath.
         """
         parser = datapath.ofproto_parser
         ofproto = datapath.ofproto
 
-        print("tps:", tp_src, tp_dst)
-
-        match = parser.OFPMatch(dl_src=src, dl_dst=dst, nw_proto=6, tp_src=tp_src, tp_dst=tp_dst)
+        match = self.flow_match(parser, src, dst, tp_src, tp_dst, in_port, nw_proto)
         actions = [parser.OFPActionOutput(out_port)]
         mod = parser.OFPFlowMod(
             datapath=datapath,
             match=match,
+            cookie=cookie,
+            idle_timeout=FLOW_IDLE_TIMEOUT,
+            # the ingress rule reports when the flow is gone
+            flags=ofproto.OFPFF_SEND_FLOW_REM if in_port is not None else 0,
             priority=1,
             actions=actions
         )
-        datapath.send_msg(mod)
-        self.logger.info(f"Flow installed: {datapath.id}, {src} -> {dst} via port {out_port}")
+        self.batcher.send(datapath, mod)
+
+    def add_tree_rule(self, datapath, match, out_port):
+        """
+        Add a permanent destination rule below the per-flow rules.
+        """
+        parser = datapath.ofproto_parser
+        mod = parser.OFPFlowMod(
+            datapath=datapath,
+            match=match,
+            cookie=0,
+            priority=TREE_RULE_PRIORITY,
+            actions=[parser.OFPActionOutput(out_port)]
+        )
+        self.batcher.send(datapath, mod)
+
+    def delete_tree_rule(self, datapath, match):
+        """
+        Delete the destination rule add_tree_rule installed with the same match.
+        """
+        parser = datapath.ofproto_parser
+        ofproto = datapath.ofproto
+        mod = parser.OFPFlowMod(
+            datapath=datapath,
+            match=match,
+            cookie=0,
+            command=ofproto.OFPFC_DELETE_STRICT,
+            priority=TREE_RULE_PRIORITY,
+            out_port=ofproto.OFPP_NONE,
+            actions=[]
+        )
+        self.batcher.send(datapath, mod)
+
+    def delete_flow(self, datapath, src, dst, tp_src, tp_dst, in_port=None, nw_proto=6):
+        """
+        Delete the flow rule add_flow installed with the same arguments.
+        """
+        parser = datapath.ofproto_parser
+        ofproto = datapath.ofproto
+
+        mod = parser.OFPFlowMod(
+            datapath=datapath,
+            match=self.flow_match(parser, src, dst, tp_src, tp_dst, in_port, nw_proto),
+            cookie=0,
+            command=ofproto.OFPFC_DELETE_STRICT,
+            priority=1,
+            out_port=ofproto.OFPP_NONE,
+            actions=[]
+        )
+        self.batcher.send(datapath, mod)
+
+    def flow_match(self, parser, src, dst, tp_src, tp_dst, in_port=None, nw_proto=6):
+        """
+        Build the match of a flow rule, the ingress rule also matches in_port.
+
+        The switch only looks at nw_proto and the L4 ports of IP packets, so
+        dl_type has to be part of the match.
+        """
+        if in_port is None:
+            return parser.OFPMatch(dl_type=ETH_TYPE_IP, dl_src=src, dl_dst=dst,
+                                   nw_proto=nw_proto, tp_src=tp_src, tp_dst=tp_dst)
+        return parser.OFPMatch(in_port=in_port, dl_type=ETH_TYPE_IP, dl_src=src, dl_dst=dst,
+                               nw_proto=nw_proto, tp_src=tp_src, tp_dst=tp_dst)
 
     def get_datapath(self, dpid):
         """
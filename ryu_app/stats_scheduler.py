@@ -0,0 +1,144 @@
+"""
+Single green thread that polls the statistics of every datapath.
+
+Datapaths are spread over the polling interval with some jitter so their
+replies do not arrive in one burst, and each poll records how late it ran
+compared with its schedule.
+
+In adaptive mode every datapath has its own interval: a datapath marked busy
+is polled at the minimum interval, a quiet one backs off exponentially up to
+the maximum interval.
+"""
+import random
+import time
+
+from ryu.lib import hub
+
+
+MAX_SLEEP = 1  # Seconds
+
+
+class StatsScheduler(object):
+
+    def __init__(self, logger, interval, request, on_cycle=None, jitter=0.1,
+                 adaptive=False, min_interval=None, max_interval=None):
+        self.logger = logger
+        self.interval = interval  # Seconds between two polls of a datapath, and between two cycles
+        self.adaptive = adaptive
+        self.min_interval = min_interval or interval
+        self.max_interval = max_interval or interval
+        self.request = request  # Called with a datapath when its poll is due
+        self.on_cycle = on_cycle  # Called once per interval
+        self.jitter = jitter  # Fraction of the interval polls are randomly shifted by
+        self.datapaths = {}  # dpid to datapath
+        self._due = {}  # dpid to the time its next poll is due
+        self._intervals = {}  # dpid to its current polling interval
+        self._busy = set()  # dpids marked busy since their last poll
+        self._next_cycle = None
+        self._thread = None
+        self.polls = 0
+        self.total_lateness = 0.0
+        self.max_lateness = 0.0
+        self.last_lateness = {}  # dpid to lateness of its last poll
+
+    def start(self):
+        """
+        Start the polling loop.
+        """
+        if self._thread is None:
+            self._next_cycle = time.time() + self.interval
+            self._thread = hub.spawn(self._run)
+
+    def register(self, datapath):
+        """
+        Start polling a datapath, replacing any previous registration of it.
+        """
+        self.datapaths[datapath.id] = datapath
+        self._intervals[datapath.id] = self.interval
+        self._due[datapath.id] = time.time() + random.uniform(0, self.interval)
+
+    def unregister(self, dpid):
+        """
+        Stop polling a datapath.
+        """
+        self.datapaths.pop(dpid, None)
+        self._due.pop(dpid, None)
+        self._intervals.pop(dpid, None)
+        self._busy.discard(dpid)
+        self.last_lateness.pop(dpid, None)
+
+    def interval_of(self, dpid):
+        """
+        Return the current polling interval of a datapath.
+        """
+        return self._intervals.get(dpid, self.interval)
+
+    def mark_busy(self, dpid):
+        """
+        Poll a datapath at the minimum interval, starting no later than one
+        minimum interval from now.
+        """
+        if not self.adaptive or dpid not in self._due:
+            return
+        self._busy.add(dpid)
+        self._due[dpid] = min(self._due[dpid], time.time() + self.min_interval)
+
+    def _next_interval(self, dpid):
+        if not self.adaptive:
+            return self.interval
+        if dpid in self._busy:
+            self._busy.discard(dpid)
+            interval = self.min_interval
+        else:
+            interval = min(2 * self._intervals[dpid], self.max_interval)
+        self._intervals[dpid] = interval
+        return interval
+
+    def stats(self):
+        """
+        Return how late the polls ran compared with their schedule.
+        """
+        return {
+            'datapaths': len(self.datapaths),
+            'polls': self.polls,
+            'mean_lateness': self.total_lateness / self.polls if self.polls else 0.0,
+            'max_lateness': self.max_lateness,
+            'mean_interval': sum(self._intervals.values()) / len(self._intervals) if self._intervals else 0.0,
+        }
+
+    def _run(self):
+        while True:
+            now = time.time()
+            for dpid, due in list(self._due.items()):
+                if due > now:
+                    continue
+                self._poll(dpid, now - due)
+                if dpid not in self._due:
+                    continue
+                interval = self._next_interval(dpid)
+                next_due = due + interval * (1 + random.uniform(-self.jitter, self.jitter))
+                # Do not try to catch up on polls that were missed entirely
+                self._due[dpid] = next_due if next_due > now else now + interval
+
+            if now >= self._next_cycle:
+                self._next_cycle += self.interval
+                if self.on_cycle is not None:
+                    try:
+                        self.on_cycle()
+                    except Exception:
+                        self.logger.exception("Stats cycle failed")
+                self.logger.debug("Stats scheduler: %s", self.stats())
+
+            # Wake up at least every MAX_SLEEP seconds to pick up new datapaths
+            wake_up = min(list(self._due.values()) + [self._next_cycle, now + MAX_SLEEP])
+            hub.sleep(max(wake_up - time.time(), 0))
+
+    def _poll(self, dpid, lateness):
+        self.polls += 1
+        self.total_lateness += lateness
+        self.max_lateness = max(self.max_lateness, lateness)
+        self.last_lateness[dpid] = lateness
+        try:
+            self.request(self.datapaths[dpid])
+        except Exception:
+            self.logger.exception("Stats request to datapath %s failed", dpid)
@@ -0,0 +1,103 @@
+"""
+Background exporter for topology snapshots.
+
+The controller only marks the topology as dirty; a green thread copies the
+graphs at most once per interval and hands the copy to a native thread that
+serializes it and writes it to disk, so the Ryu event loop never blocks on
+file I/O or rendering. PNGs are only rendered if the exporter is created with
+png=True, and matplotlib is only imported then.
+"""
+import json
+import os
+import time
+
+import networkx as nx
+from eventlet import tpool
+from ryu.lib import hub
+
+
+class TopologySnapshotExporter(object):
+
+    def __init__(self, logger, directory='.', formats=('json',), interval=5, png=False):
+        self.logger = logger
+        self.directory = directory
+        self.formats = formats
+        self.interval = interval
+        self.png = png
+        self._graph = None
+        self._mst = None
+        self._epoch = None
+        self._dirty = False
+        self._thread = None
+
+    def start(self):
+        """
+        Start the background export loop.
+        """
+        if self._thread is None:
+            self._thread = hub.spawn(self._export_loop)
+
+    def mark_dirty(self, graph, mst, epoch):
+        """
+        Record that the topology changed. This is O(1), the graphs are only
+        copied when the next snapshot is due.
+        """
+        self._graph = graph
+        self._mst = mst
+        self._epoch = epoch
+        self._dirty = True
+
+    def _export_loop(self):
+        while True:
+            hub.sleep(self.interval)
+            if not self._dirty or self._graph is None:
+                continue
+            self._dirty = False
+
+            # Copy on the event loop so the writer never sees a graph being mutated
+            graph = self._graph.copy()
+            mst = self._mst.copy()
+            try:
+                tpool.execute(self._write_snapshot, graph, mst, self._epoch, self.png)
+            except Exception:
+                self.logger.exception("Failed to export topology snapshot")
+
+    def _write_snapshot(self, graph, mst, epoch, png):
+        start = time.time()
+        if 'json' in self.formats:
+            self._write_json(graph, mst, epoch)
+        if 'graphml' in self.formats:
+            self._write_atomic("network_graph.graphml", lambda f: nx.write_graphml(graph, f))
+            self._write_atomic("mst.graphml", lambda f: nx.write_graphml(mst, f))
+        if png:
+            self._write_png(graph, "network_graph.png")
+            self._write_png(mst, "mst.png")
+        self.logger.debug("Exported topology snapshot for epoch %s in %.3fs", epoch, time.time() - start)
+
+    def _write_json(self, graph, mst, epoch):
+        snapshot = {
+            'epoch': epoch,
+            'time': time.time(),
+            'nodes': [dict(data, id=node) for node, data in graph.nodes(data=True)],
+            'links': [dict(data, source=u, target=v) for u, v, data in graph.edges(data=True)],
+            'mst': [[u, v] for u, v in mst.edges()],
+        }
+        self._write_atomic("topology.json", lambda f: f.write(json.dumps(snapshot).encode()))
+
+    def _write_png(self, graph, filename):
+        # Imported lazily so a controller that never asks for PNGs never loads matplotlib
+        import matplotlib
+        matplotlib.use('Agg')
+        from matplotlib.figure import Figure
+
+        fig = Figure()
+        ax = fig.subplots()
+        nx.draw(graph, ax=ax, with_labels=True, font_weight='bold')
+        self._write_atomic(filename, lambda f: fig.savefig(f, format='png'))
+
+    def _write_atomic(self, filename, write):
+        path = os.path.join(self.directory, filename)
+        tmp_path = path + '.tmp'
+        with open(tmp_path, 'wb') as f:
+            write(f)
+        os.replace(tmp_path, path)